@@ -1,31 +1,146 @@
 import os
 import re
-import json
 import logging
 import asyncio
+import hashlib
+import random
+import string
+import time
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, Any, List, Optional, Tuple
+from functools import lru_cache
+from typing import Dict, Any, FrozenSet, Iterator, List, NamedTuple, Optional, Tuple
+from zoneinfo import ZoneInfo
 
-import pytz
-from openai import AsyncOpenAI, APITimeoutError, RateLimitError, APIStatusError
+import httpx
+import orjson
+from openai import AsyncOpenAI, APIConnectionError, RateLimitError, APIStatusError
 
 logger = logging.getLogger(__name__)
 
 # ============================================================
 # CONFIG
 # ============================================================
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Pool HTTP propio para OpenAI: con los límites por defecto de httpx las
+# conversaciones concurrentes se forman detrás del pool y la latencia se dispara.
+_openai_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    # HTTP/2: chat y Whisper concurrentes se multiplexan sobre la misma conexión TLS
+    http2=True,
+)
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=_openai_http_client)
 MODEL_NAME = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
+
+async def close_openai_client() -> None:
+    """Cierra el pool HTTP de OpenAI (llamar en el shutdown del lifespan)."""
+    await client.close()
+
+# ============================================================
+# CONVERSATION STATE
+# ============================================================
+# Historial guardado (MemoryStore) y la parte que entra al prompt, en caracteres
+_HISTORY_MAX_CHARS = 4000
+_PROMPT_HISTORY_CHARS = 3000
+
+
+def _append_history(history: str, user_message: str, reply: str) -> str:
+    """Agrega el turno C:/A: al historial y recorta a _HISTORY_MAX_CHARS (solo copia si se pasa)."""
+    turn = f"C: {user_message}\nA: {reply}".rstrip()
+    text = f"{history}\n{turn}" if history else turn
+    if len(text) > _HISTORY_MAX_CHARS:
+        text = text[-_HISTORY_MAX_CHARS:]
+    return text
+
+
+def _safe_int(v: Any, default: int = 0) -> int:
+    """int() tolerante; el caso común (ya es int tras el primer turno) no pasa por try/except."""
+    if type(v) is int:
+        return v
+    try:
+        return int(v)
+    except (ValueError, TypeError, OverflowError):
+        return default
+
+
+@dataclass(slots=True)
+class ConvState:
+    """
+    Contexto de la conversación ya limpio (strings sin espacios, enteros ya convertidos).
+    Se arma una vez por turno desde el dict guardado en MemoryStore y se vuelve a dict al final.
+    """
+    history: str = ""
+    user_name: str = ""
+    last_interest: str = ""
+    last_appointment: str = ""
+    last_payment: str = ""
+    turn_count: int = 0
+    photo_model: str = ""
+    photo_index: int = 0
+    last_pdf_request_type: Optional[str] = None
+    funnel_stage: str = ""
+
+    @classmethod
+    def from_dict(cls, ctx: Optional[Dict[str, Any]]) -> "ConvState":
+        ctx = ctx or {}
+        return cls(
+            history=(ctx.get("history") or "").strip(),
+            user_name=(ctx.get("user_name") or "").strip(),
+            last_interest=(ctx.get("last_interest") or "").strip(),
+            last_appointment=(ctx.get("last_appointment") or "").strip(),
+            last_payment=(ctx.get("last_payment") or "").strip(),
+            turn_count=_safe_int(ctx.get("turn_count", 0)),
+            photo_model=(ctx.get("photo_model") or "").strip(),
+            photo_index=_safe_int(ctx.get("photo_index", 0)),
+            last_pdf_request_type=ctx.get("last_pdf_request_type"),
+            funnel_stage=ctx.get("funnel_stage") or "",
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "history": self.history,
+            "user_name": self.user_name,
+            "last_interest": self.last_interest,
+            "last_appointment": self.last_appointment,
+            "last_payment": self.last_payment,
+            "turn_count": self.turn_count,
+            "photo_model": self.photo_model or None,
+            "photo_index": self.photo_index,
+            "last_pdf_request_type": self.last_pdf_request_type,
+            "funnel_stage": self.funnel_stage,
+        }
+
+
 # ============================================================
 # TIME (CDMX)
 # ============================================================
+_TZ_CDMX = ZoneInfo("America/Mexico_City")
+
+# Nombres en español indexados por month - 1 / weekday() (el servidor tiene locale inglés)
+_MESES_ES = (
+    "enero", "febrero", "marzo", "abril", "mayo", "junio",
+    "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre",
+)
+_DIAS_ES = ("lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo")
+
+# (segundo epoch, datetime, texto) de la última llamada; en ráfagas muchos
+# turnos caen en el mismo segundo y no vale la pena recalcular.
+_LAST_MEXICO_TIME: Tuple[int, Optional[datetime], str] = (0, None, "")
+
+
 def get_mexico_time() -> Tuple[datetime, str]:
     """Returns current datetime in Mexico City timezone and a readable string."""
+    global _LAST_MEXICO_TIME
+    sec = int(time.time())
+    cached_sec, cached_now, cached_str = _LAST_MEXICO_TIME
+    if sec == cached_sec and cached_now is not None:
+        return cached_now, cached_str
     try:
-        tz = pytz.timezone("America/Mexico_City")
-        now = datetime.now(tz)
-        return now, now.strftime("%A %I:%M %p")
+        now = datetime.now(_TZ_CDMX)
+        now_str = now.strftime("%A %I:%M %p")
+        _LAST_MEXICO_TIME = (sec, now, now_str)
+        return now, now_str
     except Exception as e:
         logger.error(f"Timezone error: {e}")
         now = datetime.now()
@@ -166,113 +281,368 @@ REGLAS OBLIGATORIAS:
 """.strip()
 
 
+def _compile_prompt_template(template: str) -> Tuple[Tuple[str, ...], Tuple[Tuple[int, str], ...]]:
+    """
+    Parte la plantilla una sola vez en trozos literales (ya sin escapes {{ }} y con los
+    literales contiguos unidos) y la lista de (posición, campo) a rellenar en cada render.
+    """
+    chunks: List[str] = []
+    slots: List[Tuple[int, str]] = []
+    for literal, field, _spec, _conv in string.Formatter().parse(template):
+        if literal:
+            if chunks and (not slots or slots[-1][0] != len(chunks) - 1):
+                chunks[-1] += literal
+            else:
+                chunks.append(literal)
+        if field is not None:
+            slots.append((len(chunks), field))
+            chunks.append("")
+    return tuple(chunks), tuple(slots)
+
+
+_SYSTEM_PROMPT_CHUNKS, _SYSTEM_PROMPT_SLOTS = _compile_prompt_template(SYSTEM_PROMPT)
+
+
+def _render_system_prompt(values: Dict[str, Any]) -> str:
+    """Equivalente a SYSTEM_PROMPT.format(**values): copia los trozos y rellena los campos."""
+    chunks = list(_SYSTEM_PROMPT_CHUNKS)
+    for pos, field in _SYSTEM_PROMPT_SLOTS:
+        chunks[pos] = str(values[field])
+    return "".join(chunks)
+
+
+# ============================================================
+# OPENAI CALL (con coalescencia de peticiones idénticas)
+# ============================================================
+# Turnos concurrentes con la misma llave comparten una sola llamada. Como la llave
+# cubre el historial completo y la hora al minuto, en la práctica solo se juntan
+# primeros mensajes idénticos de distintos clientes dentro del mismo minuto.
+_INFLIGHT_REPLIES: Dict[str, "asyncio.Task[str]"] = {}
+
+
+def _completion_key(messages: List[Dict[str, str]]) -> str:
+    """
+    Hash de la lista de mensajes tal cual se envía al modelo.
+    Solo coincide si el modelo recibiría exactamente la misma entrada.
+    """
+    return hashlib.blake2b(orjson.dumps(messages), digest_size=16).hexdigest()
+
+
+def _openai_backoff(attempt: int, rate_limited: bool) -> float:
+    """Backoff exponencial con jitter; más largo para 429 que para timeouts/5xx."""
+    if rate_limited:
+        return min(2 ** (attempt + 1), 30) + random.random()
+    return min(0.5 * 2 ** attempt, 8) + random.random()
+
+
+async def _create_completion(messages: List[Dict[str, str]]) -> str:
+    """Llama a OpenAI con retry y regresa el texto crudo de la respuesta."""
+    # max_retries=0 solo aquí: el retry lo maneja este loop (con jitter); si no, el SDK
+    # reintenta por su cuenta dentro de cada intento nuestro. Whisper y demás usan el default.
+    no_retry_client = client.with_options(max_retries=0)
+    _MAX_RETRIES = 5
+    for _attempt in range(_MAX_RETRIES):
+        try:
+            resp = await no_retry_client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                temperature=0.3,
+                max_tokens=350,
+            )
+            break
+        except (APIConnectionError, RateLimitError) as e:
+            # APIConnectionError incluye APITimeoutError
+            if _attempt < _MAX_RETRIES - 1:
+                backoff = _openai_backoff(_attempt, isinstance(e, RateLimitError))
+                logger.warning(f"⚠️ OpenAI retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff:.1f}s: {e}")
+                await asyncio.sleep(backoff)
+            else:
+                raise
+        except APIStatusError as e:
+            # 4xx (request inválido, auth, etc.) no se arregla reintentando
+            if e.status_code >= 500 and _attempt < _MAX_RETRIES - 1:
+                backoff = _openai_backoff(_attempt, False)
+                logger.warning(f"⚠️ OpenAI 5xx retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff:.1f}s: {e}")
+                await asyncio.sleep(backoff)
+            else:
+                raise
+
+    return resp.choices[0].message.content or ""
+
+
+async def _coalesced_completion(key: str, messages: List[Dict[str, str]]) -> str:
+    """Si ya hay una llamada en curso con la misma llave, espera su resultado en vez de duplicarla."""
+    pending = _INFLIGHT_REPLIES.get(key)
+    if pending is not None:
+        logger.info("🔗 Petición idéntica en curso, reutilizando su respuesta")
+        return await asyncio.shield(pending)
+
+    task = asyncio.ensure_future(_create_completion(messages))
+    _INFLIGHT_REPLIES[key] = task
+    task.add_done_callback(lambda t: _release_inflight(key, t))
+    return await asyncio.shield(task)
+
+
+def _release_inflight(key: str, task: "asyncio.Task[str]") -> None:
+    """
+    Se quita la entrada cuando TERMINA la tarea (no cuando sale el primer caller,
+    que puede haber sido cancelado), y se consume su excepción para que asyncio
+    no avise "Task exception was never retrieved" si ya nadie la espera.
+    """
+    if _INFLIGHT_REPLIES.get(key) is task:
+        del _INFLIGHT_REPLIES[key]
+    if not task.cancelled():
+        task.exception()
+
+
 # ============================================================
 # FINANCING DATA
 # ============================================================
 _FINANCING_DATA: Optional[Dict[str, Any]] = None
+_FINANCING_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "financing.json")
+
+
+class _FinancingRecord(NamedTuple):
+    """Un modelo de financing.json con los campos que usa el prompt."""
+    key: str
+    nombre: str
+    anio: Any
+    transmision: str
+    valor: float
+    enganche: float
+    mensualidad: float
+    tasa: float
+    cat: float
+    pdf_ficha: str
+    pdf_corrida: str
+
+
+# Índice paralelo de _FINANCING_DATA (misma posición = mismo modelo).
+# Se arma una sola vez al cargar para no recalcular tokens en cada petición de PDF.
+_FIN_KEYS: Tuple[str, ...] = ()
+_FIN_YEARS: Tuple[int, ...] = ()
+_FIN_YEAR_STRS: Tuple[str, ...] = ()
+_FIN_TOKENS: Tuple[FrozenSet[str], ...] = ()
+_FIN_RECORDS: Tuple[_FinancingRecord, ...] = ()
+
+
+def _read_financing_file() -> Dict[str, Any]:
+    """Lee y parsea financing.json; {} si no existe o está mal formado."""
+    try:
+        with open(_FINANCING_PATH, "rb") as f:
+            data = orjson.loads(f.read())
+        logger.info(f"✅ Financing data loaded: {len(data)} models")
+        return data
+    except FileNotFoundError:
+        logger.warning(f"⚠️ Financing file not found: {_FINANCING_PATH}")
+    except orjson.JSONDecodeError as e:
+        logger.error(f"❌ Error parsing financing JSON: {e}")
+    return {}
 
 
-def _load_financing_data() -> Dict[str, Any]:
-    """Load financing data from JSON file (cached)."""
+def _set_financing_data(data: Dict[str, Any]) -> Dict[str, Any]:
     global _FINANCING_DATA
+    _index_financing_data(data)
+    _FINANCING_DATA = data
+    return data
+
+
+async def load_financing_data() -> Dict[str, Any]:
+    """
+    Carga financing.json fuera del event loop (llamar en el startup del lifespan),
+    para que el primer mensaje no bloquee con I/O de disco y parseo.
+    """
     if _FINANCING_DATA is not None:
         return _FINANCING_DATA
+    data = await asyncio.to_thread(_read_financing_file)
+    return _set_financing_data(data)
 
-    financing_path = os.path.join(os.path.dirname(__file__), "..", "data", "financing.json")
-    try:
-        with open(financing_path, "r", encoding="utf-8") as f:
-            _FINANCING_DATA = json.load(f)
-            logger.info(f"✅ Financing data loaded: {len(_FINANCING_DATA)} models")
-    except FileNotFoundError:
-        logger.warning(f"⚠️ Financing file not found: {financing_path}")
-        _FINANCING_DATA = {}
-    except json.JSONDecodeError as e:
-        logger.error(f"❌ Error parsing financing JSON: {e}")
-        _FINANCING_DATA = {}
 
-    return _FINANCING_DATA
+def _load_financing_data() -> Dict[str, Any]:
+    """Load financing data from JSON file (cached; fallback if startup load didn't run)."""
+    if _FINANCING_DATA is not None:
+        return _FINANCING_DATA
+    return _set_financing_data(_read_financing_file())
+
+
+def _index_financing_data(data: Dict[str, Any]) -> None:
+    """Arma _FIN_KEYS / _FIN_YEARS / _FIN_TOKENS / _FIN_RECORDS a partir de los datos de financiamiento."""
+    global _FIN_KEYS, _FIN_YEARS, _FIN_YEAR_STRS, _FIN_TOKENS, _FIN_RECORDS
+    keys: List[str] = []
+    years: List[int] = []
+    tokens: List[FrozenSet[str]] = []
+    records: List[_FinancingRecord] = []
+    for key, info in data.items():
+        nombre = info.get("nombre", "")
+        # Tokens del modelo (únicos, solo de 2+ caracteres, excluyendo "foton")
+        all_tokens = key.lower().replace("_", " ").split() + nombre.lower().split()
+        keys.append(key)
+        years.append(int(info.get("anio", 0)))
+        tokens.append(frozenset(t for t in all_tokens if len(t) >= 2 and t != "foton"))
+        records.append(_FinancingRecord(
+            key=key,
+            nombre=nombre,
+            anio=info.get("anio", ""),
+            transmision=info.get("transmision", ""),
+            valor=info.get("valor_factura", 0),
+            enganche=info.get("enganche_min", 0),
+            mensualidad=info.get("pago_mensual_total_mes_1", 0),
+            tasa=info.get("tasa_anual_pct", 0),
+            cat=info.get("cat_sin_iva_pct", 0),
+            pdf_ficha=info.get("pdf_ficha_tecnica", ""),
+            pdf_corrida=info.get("pdf_corrida", ""),
+        ))
+    _FIN_KEYS, _FIN_YEARS, _FIN_TOKENS = tuple(keys), tuple(years), tuple(tokens)
+    _FIN_YEAR_STRS = tuple(str(anio) for anio in years)
+    _FIN_RECORDS = tuple(records)
+
+
+def _score_financing_models(interest_norm: str, last_interest: str) -> Tuple[int, int, int]:
+    """
+    Recorre el índice de financiamiento y regresa (posición, score, año) del mejor modelo,
+    o (-1, 0, 0) si ninguno alcanza score >= 2.
+    """
+    best_idx = -1
+    best_score = 0
+    best_year = 0
+
+    for idx, anio in enumerate(_FIN_YEARS):
+        # Verificar si hay coincidencia (tokens ya filtrados al indexar)
+        score = sum(1 for token in _FIN_TOKENS[idx] if token in interest_norm)
+
+        # También verificar año - bonus alto si hay coincidencia exacta
+        year_str = _FIN_YEAR_STRS[idx]
+        if year_str in interest_norm or year_str in last_interest:
+            score += 3  # Bonus alto por año exacto
+
+        if score > 0:
+            logger.debug(f"📄 Candidato '{_FIN_KEYS[idx]}': score={score}, año={anio}")
+
+        # Aceptar si score >= 2
+        # Preferir: mayor score, o mismo score pero año más reciente
+        if score >= 2:
+            if best_idx < 0 or score > best_score or (score == best_score and anio > best_year):
+                best_idx = idx
+                best_score = score
+                best_year = anio
+
+    return best_idx, best_score, best_year
+
+
+# (data, texto) de la última vez que se armó; data solo cambia al recargar.
+_FINANCING_TEXT_CACHE: Optional[Tuple[Dict[str, Any], str]] = None
 
 
 def _build_financing_text() -> str:
-    """Build financing info text for GPT context."""
+    """Build financing info text for GPT context (cached per loaded data)."""
+    global _FINANCING_TEXT_CACHE
     data = _load_financing_data()
-    if not data:
+    if _FINANCING_TEXT_CACHE is not None and _FINANCING_TEXT_CACHE[0] is data:
+        return _FINANCING_TEXT_CACHE[1]
+
+    text = _render_financing_text(_FIN_RECORDS)
+    _FINANCING_TEXT_CACHE = (data, text)
+    return text
+
+
+def _render_financing_text(records: Tuple[_FinancingRecord, ...]) -> str:
+    if not records:
         return "Corridas de financiamiento no disponibles."
 
     lines = ["CORRIDAS FINANCIERAS (Banorte - Ilustrativas):"]
     lines.append("Enganche mínimo: 20% | Plazo base: 48 meses | Mensualidades YA incluyen intereses y seguros\n")
 
-    for key, info in data.items():
-        nombre = info.get("nombre", "")
-        anio = info.get("anio", "")
-        transmision = info.get("transmision", "")
-        valor = info.get("valor_factura", 0)
-        enganche = info.get("enganche_min", 0)
-        mensualidad = info.get("pago_mensual_total_mes_1", 0)
-        tasa = info.get("tasa_anual_pct", 0)
-        cat = info.get("cat_sin_iva_pct", 0)
-
-        trans_text = f" ({transmision})" if transmision else ""
+    for rec in records:
+        trans_text = f" ({rec.transmision})" if rec.transmision else ""
         lines.append(
-            f"- {nombre} {anio}{trans_text}: "
-            f"Factura ${valor:,.0f} | "
-            f"Enganche 20% = ${enganche:,.0f} | "
-            f"Mensualidad ~${mensualidad:,.2f} | "
-            f"Tasa {tasa}% | CAT {cat}%"
+            f"- {rec.nombre} {rec.anio}{trans_text}: "
+            f"Factura ${rec.valor:,.0f} | "
+            f"Enganche 20% = ${rec.enganche:,.0f} | "
+            f"Mensualidad ~${rec.mensualidad:,.2f} | "
+            f"Tasa {rec.tasa}% | CAT {rec.cat}%"
         )
 
     return "\n".join(lines)
 
 
-def _detect_pdf_request(user_message: str, last_interest: str, context: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+# ============================================================
+# PDF KEYWORDS (compiladas una sola vez al importar)
+# ============================================================
+def _keyword_re(keywords: Tuple[str, ...]) -> re.Pattern:
+    """Compila keywords literales en una sola alternancia (equivale a any(k in msg))."""
+    return re.compile("|".join(re.escape(k) for k in keywords))
+
+
+# Detectar tipo de PDF solicitado (con typos comunes).
+# Orden: lo que más se pide primero. Se omiten frases que ya contienen otra
+# keyword ("ficha tecnica" ⊃ "ficha", "pasamela" ⊃ "pasame"): nunca cambian el resultado.
+_FICHA_KEYWORDS = (
+    "ficha", "especificaciones", "caracteristicas", "características", "specs",
+    "hoja tecnica", "hoja técnica", "datos tecnicos", "datos técnicos",
+    "fiche", "fixa", "ficah",  # typos
+)
+_CORRIDA_KEYWORDS = (
+    "corrida", "financiamiento", "simulacion", "simulación",
+    "plan de pagos", "tabla de pagos", "pagos mensuales", "mensualidades pdf", "cuotas",
+    "corrda", "corida",  # typos
+)
+# Keywords genéricos que continúan un PDF previo
+_GENERIC_SEND_KEYWORDS = (
+    "pasame", "mandame", "enviame", "la quiero", "dame",
+    "pásame", "mándame", "envíame", "dámela",
+    "pasala", "pásala", "mandala", "mándala", "enviala", "envíala",
+    "comparteme", "compárteme", "compartela", "compártela",
+)
+
+_FICHA_RE = _keyword_re(_FICHA_KEYWORDS)
+_CORRIDA_RE = _keyword_re(_CORRIDA_KEYWORDS)
+_GENERIC_SEND_RE = _keyword_re(_GENERIC_SEND_KEYWORDS)
+# Mensajes más cortos que la keyword más corta no pueden pedir PDF
+_MIN_PDF_KEYWORD_LEN = min(len(k) for k in _FICHA_KEYWORDS + _CORRIDA_KEYWORDS + _GENERIC_SEND_KEYWORDS)
+
+# Palabras que no distinguen modelos en financiamiento (se quitan de last_interest)
+_INTEREST_STRIP_RE = re.compile(r"foton|diesel|4x4")
+
+
+class PDFResponse(NamedTuple):
+    """Resultado de _detect_pdf_request (viaja en result["pdf_info"] hasta main.py)."""
+    tipo: str
+    pdf_url: Optional[str] = None
+    filename: Optional[str] = None
+    mensaje: Optional[str] = None
+    modelo: Optional[str] = None
+    sin_modelo: bool = False
+    sin_datos: bool = False
+    sin_pdf: bool = False
+
+
+def _detect_pdf_request(msg_norm: str, last_interest: str, last_pdf_type: Optional[str] = None) -> Optional[PDFResponse]:
     """
     Detecta si el usuario pide un PDF (ficha técnica o corrida).
-    Retorna dict con: tipo, pdf_url, filename, mensaje_previo
+    msg_norm: mensaje del usuario ya pasado por _normalize_spanish (minúsculas).
+    last_pdf_type: tipo del último PDF pedido en la conversación (para "pásamela").
+    Retorna PDFResponse (tipo, pdf_url, filename, mensaje, modelo o la bandera sin_*)
     O None si no pide PDF.
 
     Ahora con soporte de contexto para:
     - Typos comunes ("fiche", "fixa", "corrda")
     - Peticiones genéricas ("pásamela", "mándamela") si hubo PDF previo
     """
-    msg = (user_message or "").lower()
-    context = context or {}
-
-    # Detectar tipo de PDF solicitado (con typos comunes)
-    ficha_keywords = [
-        "ficha", "fiche", "fixa", "ficah",  # typos
-        "ficha tecnica", "ficha técnica",
-        "especificaciones", "specs", "caracteristicas", "características",
-        "hoja tecnica", "hoja técnica", "datos tecnicos", "datos técnicos"
-    ]
-    corrida_keywords = [
-        "corrida", "corrda", "corida",  # typos
-        "simulacion", "simulación", "simulacion de",
-        "financiamiento", "tabla de pagos",
-        "mensualidades pdf", "pagos mensuales",
-        "plan de pagos", "cuotas"
-    ]
-
-    # Keywords genéricos que continúan un PDF previo
-    generic_send_keywords = [
-        "pasame", "pásame", "pasala", "pásala", "pasamela", "pásamela",
-        "mandame", "mándame", "mandala", "mándala", "mandamela", "mándamela",
-        "enviame", "envíame", "enviala", "envíala", "enviamela", "envíamela",
-        "comparteme", "compárteme", "compartela", "compártela",
-        "dame", "dámela", "la quiero", "si la quiero", "sí la quiero"
-    ]
+    msg = msg_norm or ""
+    if len(msg) < _MIN_PDF_KEYWORD_LEN:
+        return None
 
     pdf_type = None
-    if any(k in msg for k in ficha_keywords):
+    if _FICHA_RE.search(msg):
         pdf_type = "ficha"
         logger.debug(f"📄 Keyword de ficha detectado en: '{msg}'")
-    elif any(k in msg for k in corrida_keywords):
+    elif _CORRIDA_RE.search(msg):
         pdf_type = "corrida"
         logger.debug(f"📄 Keyword de corrida detectado en: '{msg}'")
 
     # Si no hay keyword explícito, verificar si hay petición genérica + contexto previo
     if not pdf_type:
-        last_pdf_type = context.get("last_pdf_request_type")
-        if last_pdf_type and any(k in msg for k in generic_send_keywords):
+        if last_pdf_type and _GENERIC_SEND_RE.search(msg):
             pdf_type = last_pdf_type
             logger.info(f"📄 Petición genérica '{msg}' continuando PDF previo: {pdf_type}")
 
@@ -282,92 +652,49 @@ def _detect_pdf_request(user_message: str, last_interest: str, context: Dict[str
     # Necesitamos un modelo detectado
     if not last_interest:
         logger.info(f"📄 PDF {pdf_type} solicitado pero no hay last_interest")
-        return {"tipo": pdf_type, "sin_modelo": True}
+        return PDFResponse(tipo=pdf_type, sin_modelo=True)
 
     # Buscar el modelo en los datos de financiamiento
     data = _load_financing_data()
     if not data:
         logger.warning(f"📄 PDF {pdf_type} solicitado pero no hay datos de financiamiento")
-        return {"tipo": pdf_type, "sin_datos": True}
+        return PDFResponse(tipo=pdf_type, sin_datos=True)
 
     # Normalizar el interés para buscar
-    interest_norm = last_interest.lower().replace("foton", "").replace("diesel", "").replace("4x4", "").strip()
+    interest_norm = _INTEREST_STRIP_RE.sub("", last_interest.lower()).strip()
     logger.info(f"📄 Buscando modelo para PDF: last_interest='{last_interest}' -> normalizado='{interest_norm}'")
 
     # Buscar coincidencia
-    matched_key = None
-    matched_info = None
-    best_score = 0
-    best_year = 0
-
-    for key, info in data.items():
-        nombre = info.get("nombre", "").lower()
-        anio = int(info.get("anio", 0))
-
-        # Tokens del modelo (únicos, sin duplicados)
-        key_tokens = set(key.lower().replace("_", " ").split())
-        nombre_tokens = set(nombre.split())
-        all_tokens = key_tokens.union(nombre_tokens)
-
-        # Verificar si hay coincidencia (solo tokens de 2+ caracteres, excluyendo "foton")
-        score = 0
-        matched_tokens = []
-        for token in all_tokens:
-            if len(token) >= 2 and token != "foton" and token in interest_norm:
-                score += 1
-                matched_tokens.append(token)
-
-        # También verificar año - bonus alto si hay coincidencia exacta
-        year_str = str(anio)
-        if year_str in interest_norm or year_str in last_interest:
-            score += 3  # Bonus alto por año exacto
-            matched_tokens.append(f"año:{anio}")
-
-        if score > 0:
-            logger.debug(f"📄 Candidato '{key}': score={score}, año={anio}, tokens={matched_tokens}")
-
-        # Aceptar si score >= 2
-        # Preferir: mayor score, o mismo score pero año más reciente
-        if score >= 2:
-            is_better = (
-                matched_key is None or
-                score > best_score or
-                (score == best_score and anio > best_year)
-            )
-            if is_better:
-                matched_key = key
-                matched_info = info.copy()
-                matched_info["_score"] = score
-                best_score = score
-                best_year = anio
-
-    if not matched_info:
+    best_idx, best_score, best_year = _score_financing_models(interest_norm, last_interest)
+    if best_idx < 0:
         logger.info(f"📄 No se encontró modelo para '{interest_norm}' en financiamiento")
-        return {"tipo": pdf_type, "sin_modelo": True}
+        return PDFResponse(tipo=pdf_type, sin_modelo=True)
 
-    logger.info(f"📄 Modelo matched: '{matched_key}' (score={best_score}, año={best_year}) para '{last_interest}'")
+    rec = _FIN_RECORDS[best_idx]
+    logger.info(f"📄 Modelo matched: '{rec.key}' (score={best_score}, año={best_year}) para '{last_interest}'")
 
     # Obtener URL del PDF
+    nombre_archivo = (rec.nombre or "Foton").replace(" ", "_")
     if pdf_type == "ficha":
-        pdf_url = matched_info.get("pdf_ficha_tecnica")
+        pdf_url = rec.pdf_ficha
         if not pdf_url:
-            return {"tipo": pdf_type, "sin_pdf": True, "modelo": matched_info.get("nombre", "")}
-        filename = f"Ficha_Tecnica_{matched_info.get('nombre', 'Foton').replace(' ', '_')}_{matched_info.get('anio', '')}.pdf"
+            return PDFResponse(tipo=pdf_type, sin_pdf=True, modelo=rec.nombre)
+        filename = f"Ficha_Tecnica_{nombre_archivo}_{rec.anio}.pdf"
         mensaje = "Claro, te comparto la ficha tecnica en PDF."
     else:
-        pdf_url = matched_info.get("pdf_corrida")
+        pdf_url = rec.pdf_corrida
         if not pdf_url:
-            return {"tipo": pdf_type, "sin_pdf": True, "modelo": matched_info.get("nombre", "")}
-        filename = f"Corrida_Financiamiento_{matched_info.get('nombre', 'Foton').replace(' ', '_')}_{matched_info.get('anio', '')}.pdf"
+            return PDFResponse(tipo=pdf_type, sin_pdf=True, modelo=rec.nombre)
+        filename = f"Corrida_Financiamiento_{nombre_archivo}_{rec.anio}.pdf"
         mensaje = "Listo, te comparto la simulacion de financiamiento en PDF. Es ilustrativa e incluye intereses."
 
-    return {
-        "tipo": pdf_type,
-        "pdf_url": pdf_url,
-        "filename": filename,
-        "mensaje": mensaje,
-        "modelo": f"{matched_info.get('nombre', '')} {matched_info.get('anio', '')}"
-    }
+    return PDFResponse(
+        tipo=pdf_type,
+        pdf_url=pdf_url,
+        filename=filename,
+        mensaje=mensaje,
+        modelo=f"{rec.nombre} {rec.anio}",
+    )
 
 
 # ============================================================
@@ -451,64 +778,120 @@ def _normalize_fuel(raw: str) -> str:
     return raw.strip()[:30]
 
 
+class _InventoryRow(NamedTuple):
+    """Vista canónica de un item del inventario, ya resumida para el prompt."""
+    marca: str
+    modelo: str
+    anio: str
+    color: str
+    segmento: str
+    precio: str
+    combustible: str
+    motor: str
+    capacidad: str
+    llantas: str
+    garantia: str
+    ubicacion: str
+    financiamiento: str
+
+
+def _normalize_item(item: Dict[str, Any]) -> _InventoryRow:
+    """Resuelve todos los _safe_get y resúmenes de un item una sola vez."""
+    llantas = _safe_get(item, ["LLANTAS"], default="")
+    # Solo la medida de la llanta, sin repetir combustible
+    m_llanta = re.search(r"\d{3}/\d{2,3}", llantas) if llantas else None
+    return _InventoryRow(
+        marca=_safe_get(item, ["Marca", "marca"], default="Foton"),
+        modelo=_safe_get(item, ["Modelo", "modelo", "id_modelo"], default="(sin modelo)"),
+        anio=_safe_get(item, ["Anio", "Año", "anio"], default=""),
+        color=_safe_get(item, ["Color", "color"], default=""),
+        segmento=_safe_get(item, ["segmento", "descripcion_corta"], default=""),
+        precio=_format_price(
+            _safe_get(item, ["Precio", "precio"], default="N/D"),
+            _safe_get(item, ["moneda"], default="MXN"),
+            _safe_get(item, ["iva_incluido"], default=""),
+        ),
+        combustible=_normalize_fuel(_safe_get(item, ["COMBUSTIBLE", "combustible"])),
+        motor=_summarize_motor(_safe_get(item, ["MOTOR", "motor"])),
+        capacidad=_summarize_capacity(_safe_get(item, ["CAPACIDAD DE CARGA"])),
+        llantas=m_llanta.group() if m_llanta else "",
+        garantia=_safe_get(item, ["garantia_texto"], default=""),
+        ubicacion=_safe_get(item, ["ubicacion"], default=""),
+        financiamiento=_safe_get(item, ["Financiamiento"], default=""),
+    )
+
+
+def _normalized_items(inventory_service) -> List[_InventoryRow]:
+    """
+    _InventoryRow por item, calculado una vez por carga de inventario y guardado en
+    inventory_service._normalized_items como (items, filas).
+    """
+    items = getattr(inventory_service, "items", None) or []
+    cached = getattr(inventory_service, "_normalized_items", None)
+    if cached is not None and cached[0] is items:
+        return cached[1]
+
+    rows = [_normalize_item(item) for item in items]
+    try:
+        inventory_service._normalized_items = (items, rows)
+    except AttributeError:
+        pass
+    return rows
+
+
 def _build_inventory_text(inventory_service) -> str:
+    """
+    Texto de inventario para GPT. Se guarda en inventory_service._inventory_text_cache
+    como (items, texto) y se reutiliza mientras no se reasigne inventory_service.items.
+    """
     items = getattr(inventory_service, "items", None) or []
-    if not items:
+    cached = getattr(inventory_service, "_inventory_text_cache", None)
+    if cached is not None and cached[0] is items:
+        return cached[1]
+
+    text = _render_inventory_text(_normalized_items(inventory_service))
+    try:
+        inventory_service._inventory_text_cache = (items, text)
+    except AttributeError:
+        pass
+    return text
+
+
+def _render_inventory_text(rows: List[_InventoryRow]) -> str:
+    if not rows:
         return "Inventario no disponible."
 
     lines: List[str] = []
-    for item in items:
-        marca = _safe_get(item, ["Marca", "marca"], default="Foton")
-        modelo = _safe_get(item, ["Modelo", "modelo", "id_modelo"], default="(sin modelo)")
-        anio = _safe_get(item, ["Anio", "Año", "anio"], default="")
-        color = _safe_get(item, ["Color", "color"], default="")
-        segmento = _safe_get(item, ["segmento", "descripcion_corta"], default="")
-        precio = _safe_get(item, ["Precio", "precio"], default="N/D")
-        moneda = _safe_get(item, ["moneda"], default="MXN")
-        iva = _safe_get(item, ["iva_incluido"], default="")
-        combustible = _normalize_fuel(_safe_get(item, ["COMBUSTIBLE", "combustible"]))
-        motor_raw = _safe_get(item, ["MOTOR", "motor"])
-        motor = _summarize_motor(motor_raw)
-        capacidad = _summarize_capacity(_safe_get(item, ["CAPACIDAD DE CARGA"]))
-        llantas = _safe_get(item, ["LLANTAS"], default="")
-        garantia = _safe_get(item, ["garantia_texto"], default="")
-        ubicacion = _safe_get(item, ["ubicacion"], default="")
-        financiamiento = _safe_get(item, ["Financiamiento"], default="")
-
+    for row in rows:
         # Línea principal: Modelo + Precio
-        price_str = _format_price(precio, moneda, iva)
-        info = f"- {marca} {modelo} {anio}"
-        if color:
-            info += f" ({color})"
-        info += f": {price_str}"
-        if segmento:
-            info += f" [{segmento}]"
+        info = f"- {row.marca} {row.modelo} {row.anio}"
+        if row.color:
+            info += f" ({row.color})"
+        info += f": {row.precio}"
+        if row.segmento:
+            info += f" [{row.segmento}]"
 
         # Specs resumidas (solo lo útil para vender)
         specs = []
-        if combustible:
-            specs.append(combustible)
-        if motor:
-            specs.append(f"Motor: {motor}")
-        if capacidad:
-            specs.append(f"Carga: {capacidad}")
-        if llantas:
-            # Extraer solo la medida, sin repetir combustible
-            llanta_clean = llantas.split("/")[0].strip() + "/" + llantas.split("/")[1].strip() if "/" in llantas else llantas
-            m_llanta = re.search(r"\d{3}/\d{2,3}", llantas)
-            if m_llanta:
-                specs.append(f"Llantas: {m_llanta.group()}")
+        if row.combustible:
+            specs.append(row.combustible)
+        if row.motor:
+            specs.append(f"Motor: {row.motor}")
+        if row.capacidad:
+            specs.append(f"Carga: {row.capacidad}")
+        if row.llantas:
+            specs.append(f"Llantas: {row.llantas}")
         if specs:
             info += " | " + ", ".join(specs)
 
         # Datos comerciales (una línea, sin ruido)
         extras = []
-        if garantia:
-            extras.append(f"Garantía: {garantia}")
-        if financiamiento and financiamiento.upper() not in ("FALSE", "NO", "0", ""):
+        if row.garantia:
+            extras.append(f"Garantía: {row.garantia}")
+        if row.financiamiento and row.financiamiento.upper() not in ("FALSE", "NO", "0", ""):
             extras.append("Crédito disponible")
-        if ubicacion:
-            extras.append(f"Ubic: {ubicacion}")
+        if row.ubicacion:
+            extras.append(f"Ubic: {row.ubicacion}")
         if extras:
             info += " | " + ", ".join(extras)
 
@@ -517,39 +900,59 @@ def _build_inventory_text(inventory_service) -> str:
     return "\n".join(lines)
 
 
-def _extract_photos_from_item(item: Dict[str, Any]) -> List[str]:
+def _iter_photos(item: Dict[str, Any]) -> Iterator[str]:
+    """URLs de fotos del item (campo separado por '|'), sin armar la lista intermedia de split()."""
     raw = _safe_get(item, ["photos", "photo", "foto", "imagen", "imagenes", "fotos"])
-    if not raw:
-        return []
-    return [u.strip() for u in raw.split("|") if u.strip().startswith("http")]
+    start = 0
+    while start < len(raw):
+        end = raw.find("|", start)
+        part = raw[start:end if end != -1 else None].strip()
+        if part.startswith("http"):
+            yield part
+        if end == -1:
+            break
+        start = end + 1
 
 
 # ============================================================
 # NAME / PAYMENT / APPOINTMENT EXTRACTION
 # ============================================================
+# Una sola alternancia (un solo barrido del texto). El lookahead no consume texto,
+# así que encuentra cada frase aunque quede dentro del nombre de otra.
+# Si hay varias, gana la de mayor prioridad: "me llamo" > "soy" > "mi nombre es" > "con".
+_NAME_RE = re.compile(
+    r"\b(?=(me llamo|soy|mi nombre es|con)\s+"
+    r"([A-Za-zÁÉÍÓÚÑÜáéíóúñü]+(?:\s+[A-Za-zÁÉÍÓÚÑÜáéíóúñü]+){0,3})\b)",
+    re.IGNORECASE,
+)
+_NAME_PHRASE_RANK = {"me llamo": 0, "soy": 1, "mi nombre es": 2, "con": 3}
+_NAME_MAX_WORDS = {"con": 3}  # "con X" solo acepta hasta 3 palabras
+_NAME_BAD = {"aqui", "aquí", "nadie", "yo", "el", "ella", "amigo", "desconocido", "cliente", "usuario", "quien", "quién"}
+
+
 def _extract_name_from_text(text: str) -> Optional[str]:
     """Extract probable customer name (conservative)."""
     t = (text or "").strip()
     if not t:
         return None
 
-    patterns = [
-        r"\bme llamo\s+([A-Za-zÁÉÍÓÚÑÜáéíóúñü]+(?:\s+[A-Za-zÁÉÍÓÚÑÜáéíóúñü]+){0,3})\b",
-        r"\bsoy\s+([A-Za-zÁÉÍÓÚÑÜáéíóúñü]+(?:\s+[A-Za-zÁÉÍÓÚÑÜáéíóúñü]+){0,3})\b",
-        r"\bmi nombre es\s+([A-Za-zÁÉÍÓÚÑÜáéíóúñü]+(?:\s+[A-Za-zÁÉÍÓÚÑÜáéíóúñü]+){0,3})\b",
-        r"\bcon\s+([A-Za-zÁÉÍÓÚÑÜáéíóúñü]+(?:\s+[A-Za-zÁÉÍÓÚÑÜáéíóúñü]+){0,2})\b",
-    ]
+    best: Optional[Tuple[int, str, str]] = None
+    for m in _NAME_RE.finditer(t):
+        phrase = m.group(1).lower()
+        rank = _NAME_PHRASE_RANK[phrase]
+        if best is None or rank < best[0]:
+            best = (rank, phrase, m.group(2))
+            if rank == 0:
+                break
 
-    for p in patterns:
-        m = re.search(p, t, flags=re.IGNORECASE)
-        if m:
-            name = m.group(1).strip()
-            bad = {"aqui", "aquí", "nadie", "yo", "el", "ella", "amigo", "desconocido", "cliente", "usuario", "quien", "quién"}
-            if name.lower() in bad:
-                return None
-            return " ".join(w.capitalize() for w in name.split())
+    if best is None:
+        return None
 
-    return None
+    _, phrase, name = best
+    words = name.split()[: _NAME_MAX_WORDS.get(phrase, 4)]
+    if " ".join(words).lower() in _NAME_BAD:
+        return None
+    return " ".join(w.capitalize() for w in words)
 
 
 def _extract_payment_from_text(text: str) -> Optional[str]:
@@ -561,53 +964,195 @@ def _extract_payment_from_text(text: str) -> Optional[str]:
     return None
 
 
+_NORM_REPLACEMENTS = {
+    "miller": "miler",
+    "vanesa": "toano",
+    "la e5": "tunland e5",
+}
+_NORM_RE = re.compile("|".join(re.escape(k) for k in _NORM_REPLACEMENTS))
+
+
+def _norm_alias(match: re.Match) -> str:
+    return _NORM_REPLACEMENTS[match.group(0)]
+
+
+@lru_cache(maxsize=4096)
 def _normalize_spanish(text: str) -> str:
-    return (
-        (text or "")
-        .lower()
-        .replace("miller", "miler")
-        .replace("vanesa", "toano")
-        .replace("la e5", "tunland e5")
-    )
+    """
+    Minúsculas + alias de modelos, en una sola pasada de regex.
+    Memoizada: nombres de modelo, intereses y respuestas repetidas se normalizan una vez.
+    La mayoría de los textos no trae ningún alias: un `in` por alias descarta el regex.
+    """
+    low = (text or "").lower()
+    for alias in _NORM_REPLACEMENTS:
+        if alias in low:
+            return _NORM_RE.sub(_norm_alias, low)
+    return low
 
 
-def _extract_interest_from_messages(user_message: str, reply: str, inventory_service) -> Optional[str]:
-    """Infer model interest by matching inventory model tokens in user message or bot reply."""
-    items = getattr(inventory_service, "items", None) or []
-    if not items:
-        return None
+_MODEL_STOPWORDS = frozenset({"foton", "camion", "camión"})
 
-    msg_norm = _normalize_spanish(user_message)
-    rep_norm = _normalize_spanish(reply)
 
-    best: Optional[str] = None
-    best_score = 0
+def _model_index(inventory_service) -> List[Tuple[str, str, Tuple[str, ...], Dict[str, Any]]]:
+    """
+    Un registro por modelo distinto del inventario: (modelo, modelo_norm, tokens, primer item).
+    Se calcula una vez por carga de inventario y se guarda en
+    inventory_service._model_index_cache como (items, índice).
+    """
+    items = getattr(inventory_service, "items", None) or []
+    cached = getattr(inventory_service, "_model_index_cache", None)
+    if cached is not None and cached[0] is items:
+        return cached[1]
 
+    index: List[Tuple[str, str, Tuple[str, ...], Dict[str, Any]]] = []
+    seen = set()
     for item in items:
         modelo = _safe_get(item, ["Modelo", "modelo", "id_modelo"]).strip()
-        if not modelo:
+        if not modelo or modelo in seen:
             continue
-
+        seen.add(modelo)
         modelo_norm = _normalize_spanish(modelo)
         # CAMBIO: Permitir tokens de 2 caracteres para detectar G9, E5, G7, etc.
-        tokens = [t for t in modelo_norm.split() if len(t) >= 2 and t not in {"foton", "camion", "camión"}]
-        if not tokens:
-            continue
+        tokens = tuple(t for t in modelo_norm.split() if len(t) >= 2 and t not in _MODEL_STOPWORDS)
+        index.append((modelo, modelo_norm, tokens, item))
+
+    try:
+        inventory_service._model_index_cache = (items, index)
+    except AttributeError:
+        pass
+    return index
+
 
-        score = 0
+def _model_token_index(inventory_service) -> Dict[str, Tuple[int, ...]]:
+    """
+    Índice invertido token -> posiciones en _model_index (repetida si el modelo repite el token).
+    Se guarda en inventory_service._model_token_cache como (items, índice).
+    """
+    items = getattr(inventory_service, "items", None) or []
+    cached = getattr(inventory_service, "_model_token_cache", None)
+    if cached is not None and cached[0] is items:
+        return cached[1]
+
+    postings: Dict[str, List[int]] = {}
+    for pos, (_modelo, _modelo_norm, tokens, _item) in enumerate(_model_index(inventory_service)):
         for tok in tokens:
-            if tok in msg_norm:
-                score += 2
-            if tok in rep_norm:
-                score += 1
+            postings.setdefault(tok, []).append(pos)
+    token_index = {tok: tuple(positions) for tok, positions in postings.items()}
 
-        if score > best_score:
+    try:
+        inventory_service._model_token_cache = (items, token_index)
+    except AttributeError:
+        pass
+    return token_index
+
+
+def warm_inventory_indexes(inventory_service) -> None:
+    """
+    Arma de una vez los índices derivados del inventario (modelos, tokens, texto del prompt)
+    para que el primer mensaje después de una carga no los pague. Si ya están al día, no hace nada.
+    """
+    _model_token_index(inventory_service)
+    _build_inventory_text(inventory_service)
+
+
+def _best_model_match(inventory_service, msg_norm: str, rep_norm: str, msg_weight: int) -> Tuple[int, int]:
+    """
+    (posición en _model_index, score) del modelo con más tokens presentes; cada token suma
+    msg_weight si aparece en el mensaje y 1 si aparece en la respuesta. Empates: el primero.
+    Cada token distinto se busca una sola vez aunque lo compartan varios modelos.
+    """
+    scores: Dict[int, int] = {}
+    for tok, positions in _model_token_index(inventory_service).items():
+        weight = (msg_weight if tok in msg_norm else 0) + (1 if tok in rep_norm else 0)
+        if weight:
+            for pos in positions:
+                scores[pos] = scores.get(pos, 0) + weight
+
+    best_pos = -1
+    best_score = 0
+    for pos, score in scores.items():
+        if score > best_score or (score == best_score and pos < best_pos):
+            best_pos = pos
             best_score = score
-            best = modelo
+    return best_pos, best_score
+
 
+def _extract_interest_from_messages(user_message: str, reply: str, inventory_service) -> Optional[str]:
+    """Infer model interest by matching inventory model tokens in user message or bot reply."""
+    index = _model_index(inventory_service)
+    if not index:
+        return None
+
+    msg_norm = _normalize_spanish(user_message)
+    rep_norm = _normalize_spanish(reply)
+
+    best_pos, best_score = _best_model_match(inventory_service, msg_norm, rep_norm, 2)
     if best_score >= 2:
-        return best
+        return index[best_pos][0]
+
+    return None
+
 
+# Día: "mañana" gana sobre cualquier día; entre días gana el primero de la semana.
+_APPT_DAYS = {
+    "mañana": (0, "Mañana"),
+    "lunes": (1, "Lunes"),
+    "martes": (2, "Martes"),
+    "miércoles": (3, "Miércoles"),
+    "miercoles": (4, "Miércoles"),
+    "jueves": (5, "Jueves"),
+    "viernes": (6, "Viernes"),
+    "sábado": (7, "Sábado"),
+    "sabado": (8, "Sábado"),
+    "domingo": (9, "Domingo"),
+}
+_APPT_DAY_RE = re.compile("|".join(_APPT_DAYS))
+
+# Hora en una sola pasada. Lookahead de ancho cero para no consumir texto y ver todas
+# las posiciones; cada grupo marca el tipo de coincidencia:
+#   1 mediodía | 2+3 "H y media" | 2+4 "H:MM" | 2+5 "H am/pm"
+_APPT_TIME_RE = re.compile(
+    r"(?=(medio d[ií]a|mediodía)"
+    r"|\b(\d{1,2})(?:\s*y\s*(media)\b|\s*:\s*(\d{2})\b|\s*(am|pm)\b))"
+)
+_RE_TIME_24 = re.compile(r"\d{1,2}:\d{2}")
+
+
+def _appointment_time(t: str) -> Optional[str]:
+    """
+    Hora de la cita en formato 'H:MM' (24h). Prioridad: mediodía > 'y media' > 'H:MM' > am/pm;
+    dentro de cada tipo cuenta la primera aparición.
+    """
+    noon = media = hhmm = ampm = None
+    for m in _APPT_TIME_RE.finditer(t):
+        if m.group(1):
+            noon = m
+            break
+        if m.group(3):
+            if media is None:
+                media = m
+        elif m.group(4):
+            if hhmm is None:
+                hhmm = m
+        elif ampm is None:
+            ampm = m
+
+    if noon is not None:
+        return "12:00"
+    if media is not None:
+        return f"{int(media.group(2))}:30"
+    if hhmm is not None:
+        h = int(hhmm.group(2))
+        mm = int(hhmm.group(4))
+        if 0 <= h <= 23 and 0 <= mm <= 59:
+            return f"{h}:{mm:02d}"
+    if ampm is not None:
+        h = int(ampm.group(2))
+        if 1 <= h <= 12:
+            hh = h % 12
+            if ampm.group(5) == "pm":
+                hh += 12
+            return f"{hh}:00"
     return None
 
 
@@ -618,45 +1163,13 @@ def _extract_appointment_from_text(text: str) -> Optional[str]:
         return None
 
     day: Optional[str] = None
-    if "mañana" in t:
-        day = "Mañana"
-    else:
-        days = ["lunes", "martes", "miércoles", "miercoles", "jueves", "viernes", "sábado", "sabado", "domingo"]
-        for d in days:
-            if d in t:
-                day = d.capitalize().replace("Miercoles", "Miércoles").replace("Sabado", "Sábado")
-                break
+    best_rank = len(_APPT_DAYS)
+    for m in _APPT_DAY_RE.finditer(t):
+        rank, name = _APPT_DAYS[m.group(0)]
+        if rank < best_rank:
+            best_rank, day = rank, name
 
-    time_str: Optional[str] = None
-
-    # "medio dia" o "mediodía"
-    if "medio dia" in t or "mediodía" in t or "medio día" in t:
-        time_str = "12:00"
-
-    if not time_str:
-        m = re.search(r"\b(\d{1,2})\s*y\s*media\b", t)
-        if m:
-            h = int(m.group(1))
-            time_str = f"{h}:30"
-
-    if not time_str:
-        m = re.search(r"\b(\d{1,2})\s*:\s*(\d{2})\b", t)
-        if m:
-            h = int(m.group(1))
-            mm = int(m.group(2))
-            if 0 <= h <= 23 and 0 <= mm <= 59:
-                time_str = f"{h}:{mm:02d}"
-
-    if not time_str:
-        m = re.search(r"\b(\d{1,2})\s*(am|pm)\b", t)
-        if m:
-            h = int(m.group(1))
-            mer = m.group(2)
-            if 1 <= h <= 12:
-                hh = h % 12
-                if mer == "pm":
-                    hh += 12
-                time_str = f"{hh}:00"
+    time_str = _appointment_time(t)
 
     if not time_str:
         if "en la tarde" in t or "por la tarde" in t:
@@ -676,7 +1189,7 @@ def _extract_appointment_from_text(text: str) -> Optional[str]:
         return f"{h24 - 12}:{mm} PM"
 
     if day and time_str:
-        if re.fullmatch(r"\d{1,2}:\d{2}", time_str):
+        if _RE_TIME_24.fullmatch(time_str):
             h24 = int(time_str.split(":")[0])
             mm = time_str.split(":")[1]
             return f"{day} {_pretty_time_24_to_12(h24, mm)}"
@@ -686,7 +1199,7 @@ def _extract_appointment_from_text(text: str) -> Optional[str]:
         return day
 
     if time_str and not day:
-        if re.fullmatch(r"\d{1,2}:\d{2}", time_str):
+        if _RE_TIME_24.fullmatch(time_str):
             h24 = int(time_str.split(":")[0])
             mm = time_str.split(":")[1]
             return _pretty_time_24_to_12(h24, mm)
@@ -695,166 +1208,137 @@ def _extract_appointment_from_text(text: str) -> Optional[str]:
     return None
 
 
+_CONFIRMATIONS = frozenset({
+    "vale", "ok", "okey", "si", "sí", "listo", "perfecto",
+    "nos vemos", "ahí nos vemos", "mañana nos vemos",
+    "de acuerdo", "confirmo", "gracias", "está bien",
+    "entendido", "excelente", "claro", "bien", "sale",
+})
+
+
 def _message_confirms_appointment(text: str) -> bool:
     """
     Detecta si el mensaje es una confirmación de cita.
     Solo coincidencias exactas para evitar falsos positivos.
     """
     t = (text or "").strip().lower()
-    if not t:
-        return False
-
-    confirmations = [
-        "vale", "ok", "okey", "si", "sí", "listo", "perfecto",
-        "nos vemos", "ahí nos vemos", "mañana nos vemos",
-        "de acuerdo", "confirmo", "gracias", "está bien",
-        "entendido", "excelente", "claro", "bien", "sale"
-    ]
-
-    return t in confirmations
+    return bool(t) and t in _CONFIRMATIONS
 
 
 # ============================================================
 # PHOTOS LOGIC (🔥 CON MEMORIA DE ÍNDICE)
 # ============================================================
+# Keywords de fotos por clase, compiladas una vez (una pasada de regex por clase)
+_GPS_KEYWORDS = ("ubicacion", "ubicación", "donde estan", "dónde están", "direccion", "dirección", "mapa", "donde se ubican")
+# Keywords que SIEMPRE indican petición de fotos. Frases como "ver fotos",
+# "mándame foto" o "ver imágenes" ya contienen una de estas, no hace falta listarlas.
+_PHOTO_EXPLICIT_KEYWORDS = ("foto", "imagen", "imágenes")
+# Keywords que SOLO funcionan si ya hay contexto de fotos (photo_model existe)
+# Evita mandar fotos cuando dicen "otra cosa", "más información", etc.
+_PHOTO_CONTEXT_KEYWORDS = ("otra foto", "mas fotos", "más fotos", "siguiente foto", "otra imagen")
+# "otra" / "más" => una sola foto siguiente en vez de grupo
+_PHOTO_NEXT_KEYWORDS = ("otra", "mas", "más", "siguiente")
+
+_GPS_RE = _keyword_re(_GPS_KEYWORDS)
+_PHOTO_EXPLICIT_RE = _keyword_re(_PHOTO_EXPLICIT_KEYWORDS)
+_PHOTO_CONTEXT_RE = _keyword_re(_PHOTO_CONTEXT_KEYWORDS)
+_PHOTO_NEXT_RE = _keyword_re(_PHOTO_NEXT_KEYWORDS)
+
+
 def _pick_media_urls(
     user_message: str,
     reply: str,
     inventory_service,
-    context: Dict[str, Any],
+    conv: ConvState,
+    msg_norm: Optional[str] = None,
 ) -> List[str]:
     """
     Devuelve lista de URLs de fotos según el modelo detectado.
-    Ahora con MEMORIA: guarda en context['photo_index'] para saber cuál foto va.
+    Ahora con MEMORIA: guarda en conv.photo_model / conv.photo_index para saber cuál foto va.
+    msg_norm: _normalize_spanish(user_message) si el caller ya lo tiene.
     """
-    msg = _normalize_spanish(user_message)
+    # 1) Verificar si piden fotos EXPLÍCITAMENTE (o "otra foto" con contexto de fotos).
+    #    Va primero porque la gran mayoría de mensajes no piden fotos: una sola búsqueda y salimos.
+    #    Basta con minúsculas: los alias de _normalize_spanish no tocan "foto"/"imagen".
+    msg_lower = (user_message or "").lower()
+    current_photo_model = conv.photo_model
 
-    # 1) Si piden ubicación, no mandar fotos
-    gps_keywords = ["ubicacion", "ubicación", "donde estan", "dónde están", "direccion", "dirección", "mapa", "donde se ubican"]
-    if any(k in msg for k in gps_keywords):
-        return []
+    explicit_request = _PHOTO_EXPLICIT_RE.search(msg_lower) is not None
+    context_request = not explicit_request and current_photo_model and _PHOTO_CONTEXT_RE.search(msg_lower) is not None
 
-    items = getattr(inventory_service, "items", None) or []
-    if not items:
+    if not explicit_request and not context_request:
         return []
 
-    # 2) Verificar si piden fotos EXPLÍCITAMENTE
-    # Keywords que SIEMPRE indican petición de fotos
-    explicit_photo_keywords = [
-        "foto",
-        "fotos",
-        "imagen",
-        "imagenes",
-        "imágenes",
-        "ver fotos",
-        "ver imágenes",
-        "ver la foto",
-        "ver las fotos",
-        "enseñame foto",
-        "enséñame foto",
-        "muestrame foto",
-        "muéstrame foto",
-        "mandame foto",
-        "mándame foto",
-    ]
-
-    # Keywords que SOLO funcionan si ya hay contexto de fotos (photo_model existe)
-    # Evita mandar fotos cuando dicen "otra cosa", "más información", etc.
-    context_photo_keywords = ["otra foto", "mas fotos", "más fotos", "siguiente foto", "otra imagen"]
+    msg = msg_norm if msg_norm is not None else _normalize_spanish(user_message)
 
-    current_photo_model = (context.get("photo_model") or "").strip()
-
-    explicit_request = any(k in msg for k in explicit_photo_keywords)
-    context_request = current_photo_model and any(k in msg for k in context_photo_keywords)
+    # 2) Si piden ubicación, no mandar fotos
+    if _GPS_RE.search(msg):
+        return []
 
-    if not explicit_request and not context_request:
+    items = getattr(inventory_service, "items", None) or []
+    if not items:
         return []
 
     # 3) Recuperar memoria del contexto
-    last_interest = (context.get("last_interest") or "").strip()
-    current_photo_model = (context.get("photo_model") or "").strip()
-    try:
-        photo_index = int(context.get("photo_index", 0))
-    except Exception:
-        photo_index = 0
+    last_interest = conv.last_interest
+    photo_index = conv.photo_index
 
     rep_norm = _normalize_spanish(reply)
+    interest_norm = _normalize_spanish(last_interest) if last_interest else ""
+    # Modelos ya normalizados y tokenizados (se calcula una vez por carga de inventario)
+    index = _model_index(inventory_service)
 
     # 4) Detectar qué modelo quiere ver
     target_item = None
     target_model_name = ""
+    target_model_norm = ""
 
     # A) PRIORIDAD 1: Si last_interest existe y coincide con el mensaje, usarlo
     #    Esto evita que "fotos de la G9" muestre otro modelo
     if last_interest:
-        interest_norm = _normalize_spanish(last_interest)
         # Extraer tokens relevantes del interés guardado (incluir g9, e5, g7, etc.)
-        interest_tokens = [p for p in interest_norm.split() if len(p) >= 2 and p not in ["foton", "camion", "camión"]]
+        interest_tokens = [p for p in interest_norm.split() if len(p) >= 2 and p not in _MODEL_STOPWORDS]
 
         # Verificar si el mensaje menciona el modelo de interés
         if any(tok in msg for tok in interest_tokens):
-            for item in items:
-                modelo = _safe_get(item, ["Modelo", "modelo", "id_modelo"]).strip()
-                if _normalize_spanish(modelo) == interest_norm or any(tok in _normalize_spanish(modelo) for tok in interest_tokens):
+            for modelo, modelo_norm, _tokens, item in index:
+                if modelo_norm == interest_norm or any(tok in modelo_norm for tok in interest_tokens):
                     target_item = item
                     target_model_name = modelo
+                    target_model_norm = modelo_norm
                     break
 
     # B) PRIORIDAD 2: Buscar mención explícita en mensaje o respuesta del bot (con scoring)
     if not target_item:
-        best_item = None
-        best_model = ""
-        best_score = 0
-
-        for item in items:
-            modelo = _safe_get(item, ["Modelo", "modelo", "id_modelo"]).strip()
-            if not modelo:
-                continue
-
-            modelo_norm = _normalize_spanish(modelo)
-            # CAMBIO: Permitir tokens de 2 caracteres (g9, e5, g7, etc.)
-            parts = [p for p in modelo_norm.split() if len(p) >= 2 and p not in ["foton", "camion", "camión"]]
-
-            score = 0
-            for part in parts:
-                if part in msg:
-                    score += 3  # Match en mensaje del usuario = alta prioridad
-                if part in rep_norm:
-                    score += 1  # Match en respuesta del bot = menor prioridad
-
-            if score > best_score:
-                best_score = score
-                best_item = item
-                best_model = modelo
-
+        # Match en mensaje del usuario = 3 (alta prioridad), en respuesta del bot = 1
+        best_pos, best_score = _best_model_match(inventory_service, msg, rep_norm, 3)
         if best_score >= 2:  # Mínimo 2 puntos para considerar
-            target_item = best_item
-            target_model_name = best_model
+            target_model_name, target_model_norm, _tokens, target_item = index[best_pos]
 
     # C) PRIORIDAD 3: Usar last_interest sin mención (para "otra foto" sin decir modelo)
     if not target_item and last_interest:
-        for item in items:
-            modelo = _safe_get(item, ["Modelo", "modelo", "id_modelo"]).strip()
-            if _normalize_spanish(modelo) == _normalize_spanish(last_interest):
+        for modelo, modelo_norm, _tokens, item in index:
+            if modelo_norm == interest_norm:
                 target_item = item
                 target_model_name = modelo
+                target_model_norm = modelo_norm
                 break
 
     if not target_item:
         return []
 
     # 5) Extraer fotos
-    urls = _extract_photos_from_item(target_item)
+    urls = list(_iter_photos(target_item))
     if not urls:
         return []
 
     # 6) Si cambió de modelo, reiniciar índice
-    if _normalize_spanish(target_model_name) != _normalize_spanish(current_photo_model):
+    if target_model_norm != _normalize_spanish(current_photo_model):
         photo_index = 0
-        context["photo_model"] = target_model_name
+        conv.photo_model = target_model_name
 
     # 7) Determinar si quiere "otra" (1 foto) o "fotos" (grupo)
-    wants_next = any(k in msg for k in ["otra", "mas", "más", "siguiente"])
+    wants_next = _PHOTO_NEXT_RE.search(msg) is not None
     selected_urls: List[str] = []
 
     if wants_next:
@@ -881,42 +1365,53 @@ def _pick_media_urls(
             photo_index = end_index
 
     # 8) Guardar el nuevo índice en contexto
-    context["photo_index"] = photo_index
+    conv.photo_index = photo_index
     return selected_urls
 
 
-def _sanitize_reply_if_photos_attached(reply: str, media_urls: List[str]) -> str:
-    if not media_urls:
-        return reply
-
-    bad_phrases = [
-        r"no\s+puedo\s+enviar\s+fotos",
-        r"no\s+puedo\s+mandar\s+fotos",
-        r"no\s+tengo\s+fotos",
-        r"no\s+puedo\s+enviar\s+im[aá]genes",
-        r"no\s+puedo\s+mandar\s+im[aá]genes",
-        r"soy\s+una\s+ia",
-        r"soy\s+un\s+modelo",
-    ]
-
-    cleaned = reply or ""
-    for p in bad_phrases:
-        cleaned = re.sub(p, "Claro, aquí tienes.", cleaned, flags=re.IGNORECASE)
-
-    return cleaned
-
-
-def _strip_markdown_links(text: str) -> str:
+# Frases que contradicen las fotos adjuntas (una sola alternancia, compilada al importar)
+_BAD_PHRASES = (
+    r"no\s+puedo\s+enviar\s+fotos",
+    r"no\s+puedo\s+mandar\s+fotos",
+    r"no\s+tengo\s+fotos",
+    r"no\s+puedo\s+enviar\s+im[aá]genes",
+    r"no\s+puedo\s+mandar\s+im[aá]genes",
+    r"soy\s+una\s+ia",
+    r"soy\s+un\s+modelo",
+)
+_BAD_PHRASE_RE = re.compile("|".join(_BAD_PHRASES), re.IGNORECASE)
+_MD_LINK_RE = re.compile(r'\[[^\]]+\]\((https?://[^\)]+)\)')
+# Links markdown y frases prohibidas en una sola alternancia: un solo recorrido del texto
+_MD_LINK_OR_BAD_PHRASE_RE = re.compile(
+    r'\[[^\]]+\]\((?P<url>https?://[^\)]+)\)|(?i:' + "|".join(_BAD_PHRASES) + ")"
+)
+_REPLY_PREFIX_RE = re.compile(r"^(Adrian|Asesor|Bot)\s*:\s*", re.IGNORECASE)
+# Bloque ```json {...} ``` con el lead_event que agrega el modelo
+_LEAD_JSON_RE = re.compile(r"```json\s*({.*?})\s*```", re.DOTALL | re.IGNORECASE)
+_PHOTOS_ATTACHED_REPLACEMENT = "Claro, aquí tienes."
+
+
+def _replace_link_or_bad_phrase(match: re.Match) -> str:
+    url = match.group("url")
+    if url is None:
+        return _PHOTOS_ATTACHED_REPLACEMENT
+    # La frase también se reemplazaba si aparecía dentro del URL
+    return _BAD_PHRASE_RE.sub(_PHOTOS_ATTACHED_REPLACEMENT, url)
+
+
+def _finalize_reply(reply: str, photos_attached: bool) -> str:
     """
-    Convierte links markdown [texto](url) a solo el URL.
-    WhatsApp no soporta markdown links y se ven mal.
-    Ejemplo: '[Ubicación](https://maps.app.goo.gl/xxx)' -> 'https://maps.app.goo.gl/xxx'
+    Limpieza final de la respuesta en una sola pasada:
+    - Convierte links markdown [texto](url) a solo el URL.
+      WhatsApp no soporta markdown links y se ven mal.
+      Ejemplo: '[Ubicación](https://maps.app.goo.gl/xxx)' -> 'https://maps.app.goo.gl/xxx'
+    - Si van fotos adjuntas, reemplaza frases que las contradicen ("no tengo fotos", "soy una IA").
     """
-    if not text:
-        return text
-    # Pattern: [cualquier texto](url)
-    # Reemplaza con solo la URL
-    return re.sub(r'\[([^\]]+)\]\((https?://[^\)]+)\)', r'\2', text)
+    if not reply:
+        return reply
+    if photos_attached:
+        return _MD_LINK_OR_BAD_PHRASE_RE.sub(_replace_link_or_bad_phrase, reply)
+    return _MD_LINK_RE.sub(r'\1', reply)
 
 
 # ============================================================
@@ -959,16 +1454,18 @@ async def handle_message(
     context: Dict[str, Any],
 ) -> Dict[str, Any]:
     user_message = user_message or ""
+    user_message_norm = _normalize_spanish(user_message)
     context = context or {}
-    history = (context.get("history") or "").strip()
+    conv = ConvState.from_dict(context)
+    history = conv.history
 
     # Silence mode
     if user_message.strip().lower() == "/silencio":
-        new_history = (history + f"\nC: {user_message}\nA: Perfecto. Modo silencio activado.").strip()
+        new_history = _append_history(history, user_message, "Perfecto. Modo silencio activado.")
         return {
             "reply": "Perfecto. Modo silencio activado.",
             "new_state": "silent",
-            "context": {"history": new_history[-4000:]},
+            "context": {"history": new_history},
             "media_urls": [],
             "lead_info": None,
         }
@@ -983,14 +1480,11 @@ async def handle_message(
         }
 
     # Persistent context
-    saved_name = (context.get("user_name") or "").strip()
-    last_interest = (context.get("last_interest") or "").strip()
-    last_appointment = (context.get("last_appointment") or "").strip()
-    last_payment = (context.get("last_payment") or "").strip()
-    try:
-        turn_count = int(context.get("turn_count", 0)) + 1
-    except (ValueError, TypeError):
-        turn_count = 1
+    saved_name = conv.user_name
+    last_interest = conv.last_interest
+    last_appointment = conv.last_appointment
+    last_payment = conv.last_payment
+    turn_count = conv.turn_count + 1
 
     # Extract from user input
     extracted_name = _extract_name_from_text(user_message)
@@ -1008,23 +1502,14 @@ async def handle_message(
     # Time and date
     now_dt, current_time_str = get_mexico_time()
     # Formatear fecha en español manualmente (el servidor tiene locale inglés)
-    meses_es = {
-        1: "enero", 2: "febrero", 3: "marzo", 4: "abril",
-        5: "mayo", 6: "junio", 7: "julio", 8: "agosto",
-        9: "septiembre", 10: "octubre", 11: "noviembre", 12: "diciembre"
-    }
-    dias_es = {
-        0: "lunes", 1: "martes", 2: "miércoles", 3: "jueves",
-        4: "viernes", 5: "sábado", 6: "domingo"
-    }
-    current_date_str = f"{dias_es[now_dt.weekday()]} {now_dt.day} de {meses_es[now_dt.month]} de {now_dt.year}"
+    current_date_str = f"{_DIAS_ES[now_dt.weekday()]} {now_dt.day} de {_MESES_ES[now_dt.month - 1]} de {now_dt.year}"
 
-    formatted_system_prompt = SYSTEM_PROMPT.format(
-        current_time_str=current_time_str,
-        current_date_str=current_date_str,
-        user_name_context=saved_name if saved_name else "(Aún no dice su nombre)",
-        turn_number=turn_count,
-    )
+    formatted_system_prompt = _render_system_prompt({
+        "current_time_str": current_time_str,
+        "current_date_str": current_date_str,
+        "user_name_context": saved_name if saved_name else "(Aún no dice su nombre)",
+        "turn_number": turn_count,
+    })
 
     inventory_text = _build_inventory_text(inventory_service)
     financing_text = _build_financing_text()
@@ -1038,7 +1523,7 @@ async def handle_message(
         f"PAGO DETECTADO: {last_payment or '(Por definir)'}\n"
         f"INVENTARIO DISPONIBLE:\n{inventory_text}\n\n"
         f"{financing_text}\n\n"
-        f"HISTORIAL DE CHAT:\n{history[-3000:]}"
+        f"HISTORIAL DE CHAT:\n{history[-_PROMPT_HISTORY_CHARS:]}"
     )
 
     messages = [
@@ -1051,32 +1536,7 @@ async def handle_message(
     reply_clean = "Hubo un error técnico."
 
     try:
-        _MAX_RETRIES = 3
-        for _attempt in range(_MAX_RETRIES):
-            try:
-                resp = await client.chat.completions.create(
-                    model=MODEL_NAME,
-                    messages=messages,
-                    temperature=0.3,
-                    max_tokens=350,
-                )
-                break
-            except (APITimeoutError, RateLimitError) as e:
-                if _attempt < _MAX_RETRIES - 1:
-                    backoff = 2 ** (_attempt + 1)
-                    logger.warning(f"⚠️ OpenAI retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff}s: {e}")
-                    await asyncio.sleep(backoff)
-                else:
-                    raise
-            except APIStatusError as e:
-                if e.status_code >= 500 and _attempt < _MAX_RETRIES - 1:
-                    backoff = 2 ** (_attempt + 1)
-                    logger.warning(f"⚠️ OpenAI 5xx retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff}s: {e}")
-                    await asyncio.sleep(backoff)
-                else:
-                    raise
-
-        raw_reply = resp.choices[0].message.content or ""
+        raw_reply = await _coalesced_completion(_completion_key(messages), messages)
         reply_clean = raw_reply
 
         # Update interest using user+bot text
@@ -1085,10 +1545,10 @@ async def handle_message(
             last_interest = inferred_interest
 
         # Extract optional JSON from the model (inside ```json ... ```)
-        json_match = re.search(r"```json\s*({.*?})\s*```", raw_reply, flags=re.DOTALL | re.IGNORECASE)
+        json_match = _LEAD_JSON_RE.search(raw_reply) if "```" in raw_reply else None
         if json_match:
             try:
-                payload = json.loads(json_match.group(1))
+                payload = orjson.loads(json_match.group(1))
                 candidate = payload.get("lead_event") if isinstance(payload, dict) else None
 
                 if isinstance(candidate, dict):
@@ -1119,34 +1579,28 @@ async def handle_message(
         reply_clean = "Dame un momento, estoy consultando sistema..."
 
     # Clean prefixes
-    reply_clean = re.sub(
-        r"^(Adrian|Asesor|Bot)\s*:\s*",
-        "",
-        reply_clean.strip(),
-        flags=re.IGNORECASE,
-    ).strip()
-
-    # 🔥 CAMBIO CLAVE: Construir new_context ANTES de llamar a _pick_media_urls
-    new_context: Dict[str, Any] = {
-        "history": (history + f"\nC: {user_message}\nA: {reply_clean}").strip()[-4000:],
-        "user_name": saved_name,
-        "last_interest": last_interest,
-        "last_appointment": last_appointment,
-        "last_payment": last_payment,
-        "turn_count": turn_count,
+    reply_clean = _REPLY_PREFIX_RE.sub("", reply_clean.strip()).strip()
+
+    # 🔥 CAMBIO CLAVE: Construir el nuevo estado ANTES de llamar a _pick_media_urls
+    new_conv = ConvState(
+        history=_append_history(history, user_message, reply_clean),
+        user_name=saved_name,
+        last_interest=last_interest,
+        last_appointment=last_appointment,
+        last_payment=last_payment,
+        turn_count=turn_count,
         # Mantener valores previos de fotos si existen
-        "photo_model": context.get("photo_model"),
-        "photo_index": context.get("photo_index", 0),
+        photo_model=conv.photo_model,
+        photo_index=conv.photo_index,
         # Mantener tipo de PDF solicitado para peticiones genéricas
-        "last_pdf_request_type": context.get("last_pdf_request_type"),
-    }
+        last_pdf_request_type=conv.last_pdf_request_type,
+    )
 
-    # Pasamos new_context (la función lo modificará)
-    media_urls = _pick_media_urls(user_message, reply_clean, inventory_service, new_context)
-    reply_clean = _sanitize_reply_if_photos_attached(reply_clean, media_urls)
+    # Pasamos new_conv (la función lo modificará)
+    media_urls = _pick_media_urls(user_message, reply_clean, inventory_service, new_conv, user_message_norm)
 
-    # Quitar markdown links que WhatsApp no soporta
-    reply_clean = _strip_markdown_links(reply_clean)
+    # Quitar markdown links que WhatsApp no soporta (y frases anti-fotos si van adjuntas)
+    reply_clean = _finalize_reply(reply_clean, bool(media_urls))
 
     # ============================================================
     # MONDAY FAILSAFE (MEJORADO - AGRESIVO)
@@ -1202,33 +1656,33 @@ async def handle_message(
         funnel_stage = "Cita agendada"  # Cita confirmada
 
     # Agregar etapa al contexto para tracking
-    new_context["funnel_stage"] = funnel_stage
+    new_conv.funnel_stage = funnel_stage
 
     # ============================================================
     # PDF DETECTION (FICHA TÉCNICA / CORRIDA)
     # ============================================================
-    pdf_info = _detect_pdf_request(user_message, last_interest, new_context)
+    pdf_info = _detect_pdf_request(user_message_norm, last_interest, new_conv.last_pdf_request_type)
     if pdf_info:
         # Guardar tipo de PDF solicitado para peticiones genéricas posteriores
-        if pdf_info.get("tipo"):
-            new_context["last_pdf_request_type"] = pdf_info.get("tipo")
+        if pdf_info.tipo:
+            new_conv.last_pdf_request_type = pdf_info.tipo
 
-        if pdf_info.get("sin_modelo"):
+        if pdf_info.sin_modelo:
             # No hay modelo detectado, el bot debe preguntar
-            logger.info(f"📄 PDF solicitado ({pdf_info.get('tipo')}) pero sin modelo detectado")
-        elif pdf_info.get("sin_pdf"):
+            logger.info(f"📄 PDF solicitado ({pdf_info.tipo}) pero sin modelo detectado")
+        elif pdf_info.sin_pdf:
             # No tenemos el PDF de ese modelo
-            logger.info(f"📄 PDF solicitado ({pdf_info.get('tipo')}) pero no disponible para {pdf_info.get('modelo')}")
-        elif pdf_info.get("pdf_url"):
+            logger.info(f"📄 PDF solicitado ({pdf_info.tipo}) pero no disponible para {pdf_info.modelo}")
+        elif pdf_info.pdf_url:
             # Tenemos el PDF, lo vamos a enviar
-            logger.info(f"📄 PDF detectado: {pdf_info.get('tipo')} - {pdf_info.get('modelo')} - {pdf_info.get('filename')}")
+            logger.info(f"📄 PDF detectado: {pdf_info.tipo} - {pdf_info.modelo} - {pdf_info.filename}")
             # Reemplazar la respuesta del bot con el mensaje apropiado
-            reply_clean = pdf_info.get("mensaje", reply_clean)
+            reply_clean = pdf_info.mensaje or reply_clean
 
     return {
         "reply": reply_clean,
         "new_state": "chatting",
-        "context": new_context,
+        "context": new_conv.to_dict(),
         "media_urls": media_urls,
         "lead_info": lead_info,
         "funnel_stage": funnel_stage,
@@ -15,6 +15,70 @@ def _clean_cell(v):
     # convierte cualquier cosa (incluidas listas) a texto
     return (str(v) if v is not None else "").strip()
 
+def _rows_to_items(rows):
+    """
+    Filas crudas de csv.reader (la primera es el header) -> items del inventario.
+    Consume el iterador fila por fila, sin materializar la lista completa.
+    Las columnas se resuelven una sola vez por header; por fila solo se limpian
+    las celdas que se usan.
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return []
+
+    # header limpio -> posición. Igual que DictReader + limpieza: un nombre repetido
+    # toma la última columna, y el orden de limpieza es el de primera aparición.
+    raw_col = {}
+    for i, name in enumerate(header):
+        raw_col[name] = i
+    col = {_clean_cell(name): i for name, i in raw_col.items()}
+
+    def cell(row, name, default=""):
+        i = col.get(name)
+        if i is None:
+            return default
+        return _clean_cell(row[i]) if i < len(row) else ""
+
+    def first(row, *names):
+        # equivalente a row.get(a, row.get(b, ...)): la primera columna que exista
+        for name in names:
+            if name in col:
+                return cell(row, name)
+        return ""
+
+    items = []
+    for row in rows:
+        if not row:
+            continue
+
+        status = cell(row, "status").lower()
+        if status and status not in ["disponible", "available", "1", "si", "sí", "yes"]:
+            continue
+
+        items.append({
+            "Marca": cell(row, "Marca", "Foton"),
+            "Modelo": cell(row, "Modelo"),
+            "Año": first(row, "Año", "Anio"),
+            "Color": cell(row, "Color"),
+            "segmento": cell(row, "segmento"),
+            "Precio": _clean_price(first(row, "Precio", "Precio Distribuidor")),
+            "moneda": cell(row, "moneda"),
+            "iva_incluido": cell(row, "iva_incluido"),
+            "garantia_texto": cell(row, "garantia_texto"),
+            "ubicacion": cell(row, "ubicacion"),
+            "descripcion_corta": cell(row, "descripcion_corta"),
+            "Financiamiento": cell(row, "Financiamiento"),
+            "Tipo de financiamiento": cell(row, "Tipo de financiamiento"),
+            "Banco": cell(row, "Banco"),
+            "photos": cell(row, "photos"),
+            "CAPACIDAD DE CARGA": cell(row, "CAPACIDAD DE CARGA"),
+            "LLANTAS": cell(row, "LLANTAS"),
+            "COMBUSTIBLE": cell(row, "COMBUSTIBLE"),
+            "MOTOR": cell(row, "MOTOR"),
+        })
+    return items
+
 class InventoryService:
     def __init__(self, local_path: str, sheet_csv_url: str | None = None, refresh_seconds: int = 300):
         self.local_path = local_path
@@ -22,66 +86,54 @@ class InventoryService:
         self.refresh_seconds = refresh_seconds
         self.items = []
         self._last_load_ts = 0
+        # (items, texto) que arma conversation_logic._build_inventory_text
+        self._inventory_text_cache = None
+        # (items, índice de modelos) que arma conversation_logic._model_index
+        self._model_index_cache = None
+        # (items, filas normalizadas) que arma conversation_logic._normalized_items
+        self._normalized_items = None
+        # (items, token -> modelos) que arma conversation_logic._model_token_index
+        self._model_token_cache = None
+        # cliente HTTP reutilizado entre refrescos del sheet (keep-alive, sin TLS nuevo cada vez)
+        self._http: httpx.AsyncClient | None = None
 
     async def load(self, force: bool = False):
         now = time.time()
         if not force and self.items and (now - self._last_load_ts) < self.refresh_seconds:
             return
 
-        rows = []
         if self.sheet_csv_url:
             url = (self.sheet_csv_url or "").strip()
-            async with httpx.AsyncClient(timeout=20.0, follow_redirects=True) as client:
-                r = await client.get(url)
-            r.raise_for_status()
-            content = r.text
-
-            f = StringIO(content)
-            reader = csv.DictReader(f)
-            rows = list(reader)
+            if self._http is None:
+                # HTTP/2 como los demás clientes (Google Sheets lo soporta; h2 viene de httpx[http2])
+                self._http = httpx.AsyncClient(timeout=20.0, follow_redirects=True, http2=True)
+            # Se decodifica por chunks directo al buffer (sin la copia extra de r.text);
+            # el CSV se parsea al final porque un campo entre comillas puede traer saltos de línea.
+            buf = StringIO()
+            async with self._http.stream("GET", url) as r:
+                r.raise_for_status()
+                async for chunk in r.aiter_text():
+                    buf.write(chunk)
+            buf.seek(0)
+            items = _rows_to_items(csv.reader(buf))
         else:
             if not os.path.exists(self.local_path):
                 self.items = []
                 return
             with open(self.local_path, newline="", encoding="latin-1") as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
-
-        normalized = []
-        for row in rows:
-            # limpia headers/valores (a prueba de listas)
-            row = { _clean_cell(k): _clean_cell(v) for k, v in (row or {}).items() }
-
-            status = (row.get("status", "") or "").strip().lower()
-            if status and status not in ["disponible", "available", "1", "si", "sí", "yes"]:
-                continue
-
-            item = {
-                "Marca": row.get("Marca", "Foton"),
-                "Modelo": row.get("Modelo", ""),
-                "Año": row.get("Año", row.get("Anio", "")),
-                "Color": row.get("Color", ""),
-                "segmento": row.get("segmento", ""),
-                "Precio": _clean_price(row.get("Precio", row.get("Precio Distribuidor", row.get(" Precio Distribuidor", "")))),
-                "moneda": row.get("moneda", ""),
-                "iva_incluido": row.get("iva_incluido", ""),
-                "garantia_texto": row.get("garantia_texto", ""),
-                "ubicacion": row.get("ubicacion", ""),
-                "descripcion_corta": row.get("descripcion_corta", ""),
-                "Financiamiento": row.get("Financiamiento", ""),
-                "Tipo de financiamiento": row.get("Tipo de financiamiento", ""),
-                "Banco": row.get("Banco", ""),
-                "photos": row.get("photos", ""),
-                "CAPACIDAD DE CARGA": row.get("CAPACIDAD DE CARGA", ""),
-                "LLANTAS": row.get("LLANTAS", ""),
-                "COMBUSTIBLE": row.get("COMBUSTIBLE", ""),
-                "MOTOR": row.get("MOTOR", ""),
-            }
-            normalized.append(item)
+                items = _rows_to_items(csv.reader(f))
 
-        self.items = normalized
+        # Si el sheet no cambió se conserva la misma lista: los caches derivados
+        # (texto para GPT, índices de modelos) se validan por identidad de self.items
+        # y así sobreviven al refresco periódico sin reconstruirse.
+        if items != self.items:
+            self.items = items
         self._last_load_ts = now
 
     async def ensure_loaded(self):
         await self.load(force=False)
 
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
@@ -1,23 +1,25 @@
 import os
-import json
 import logging
 import asyncio
-import tempfile
 import random
 import time
 import re
 import base64
 from contextlib import asynccontextmanager
-from collections import deque, OrderedDict
-from typing import Any, Dict, List, Optional, Tuple
+from collections import OrderedDict, defaultdict
+from itertools import islice
+from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple
 
 import httpx
-from fastapi import FastAPI, Request
+import orjson
+from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi.responses import JSONResponse
 from pydantic_settings import BaseSettings
 
 # === IMPORTACIONES PROPIAS ===
 from src.inventory_service import InventoryService
-from src.conversation_logic import handle_message
+from src.conversation_logic import handle_message, close_openai_client, load_financing_data, warm_inventory_indexes
+from src.conversation_logic import client as openai_client
 from src.memory_store import MemoryStore
 from src.monday_service import monday_service
 
@@ -33,6 +35,7 @@ class Settings(BaseSettings):
     OWNER_PHONE: Optional[str] = None
     SHEET_CSV_URL: Optional[str] = None
     INVENTORY_REFRESH_SECONDS: int = 300
+    EVOLUTION_MAX_RPS: float = 20.0  # Tope de requests/seg hacia Evolution (token bucket)
 
     # Logging del payload (evita logs gigantes)
     LOG_WEBHOOK_PAYLOAD: bool = True
@@ -72,17 +75,24 @@ if TEAM_NUMBERS_LIST:
 
 # === 2. ESTADO GLOBAL EN RAM ===
 class BoundedOrderedSet:
-    """Set con O(1) lookup y evicción FIFO al llegar al límite."""
+    """
+    Set con O(1) lookup y evicción FIFO al llegar al límite.
+    Respaldado por un dict normal (mantiene orden de inserción y ocupa ~la mitad que
+    OrderedDict). Al llenarse se descarta de golpe el 1/8 más viejo: sacar las llaves
+    del frente de un dict una por una re-escanea los huecos que van quedando.
+    """
 
     def __init__(self, maxlen: int):
-        self._data: OrderedDict = OrderedDict()
+        self._data: Dict[Any, None] = {}
         self._maxlen = maxlen
+        self._evict_batch = max(1, maxlen // 8)
 
     def add(self, key):
         if key in self._data:
             return
         if len(self._data) >= self._maxlen:
-            self._data.popitem(last=False)
+            for old in list(islice(self._data, self._evict_batch)):
+                del self._data[old]
         self._data[key] = None
 
     def __contains__(self, key):
@@ -92,10 +102,52 @@ class BoundedOrderedSet:
         return len(self._data)
 
 
+class BoundedLRU(OrderedDict):
+    """
+    Dict con tope de entradas: al pasarse descarta la menos usada.
+    Leer con [] o escribir una llave la marca como la más reciente.
+    """
+
+    def __init__(self, maxlen: int):
+        super().__init__()
+        self._maxlen = maxlen
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.move_to_end(key)
+        super().__setitem__(key, value)
+        if len(self) > self._maxlen:
+            self.popitem(last=False)
+
+
+# Textos recientes del bot que se recuerdan por chat (CAPA 2 de _is_bot_message)
+_BOT_SENT_TEXTS_PER_CHAT = 10
+
+
 class GlobalState:
+    __slots__ = (
+        "http_client", "inventory", "inventory_refresh_task", "inventory_query_count",
+        "inventory_idle", "inventory_wake", "store",
+        "processed_message_ids", "processed_lead_ids", "silenced_users",
+        "bot_sent_message_ids", "bot_sent_texts", "last_bot_message_time",
+        "pending_messages", "pending_message_tasks", "pending_deadlines",
+        "crm_queue", "crm_worker", "background_tasks",
+    )
+
     def __init__(self):
         self.http_client: Optional[httpx.AsyncClient] = None
         self.inventory: Optional[InventoryService] = None
+        self.inventory_refresh_task: Optional[asyncio.Task] = None
+        # Turnos atendidos desde el último refresco (sin uso no se descarga el sheet)
+        self.inventory_query_count: int = 0
+        # El último tick se saltó por falta de uso: la siguiente consulta despierta al loop
+        self.inventory_idle: bool = False
+        self.inventory_wake = asyncio.Event()
         self.store: Optional[MemoryStore] = None
 
         # dedupe RAM (O(1) lookup con evicción FIFO)
@@ -103,17 +155,36 @@ class GlobalState:
         self.processed_lead_ids = BoundedOrderedSet(maxlen=8000)
 
         # Silencios (ahora soporta timestamp o bool)
+        # jid -> True (permanente) o plazo en time.monotonic() (inmune a ajustes del reloj)
         self.silenced_users: Dict[str, Any] = {}
 
         # 🆕 HANDOFF: Rastreo de mensajes del bot
         self.bot_sent_message_ids = BoundedOrderedSet(maxlen=2000)
-        self.bot_sent_texts: Dict[str, deque] = {}
-        self.last_bot_message_time: Dict[str, float] = {}
+        # jid -> hash() de los últimos textos enviados (dict como set ordenado: lookup O(1),
+        # evicción del más viejo). Solo se compara igualdad, no hace falta guardar el texto.
+        # Por jid: acotados como LRU para que los chats viejos no acumulen memoria sin fin
+        self.bot_sent_texts: Dict[str, Dict[int, None]] = BoundedLRU(maxlen=2000)
+        self.last_bot_message_time: Dict[str, float] = BoundedLRU(maxlen=5000)  # jid -> time.monotonic()
 
         # 🆕 ACUMULACIÓN DE MENSAJES: Agrupa mensajes rápidos del cliente
-        self.pending_messages: Dict[str, List[str]] = {}  # jid -> [msg1, msg2, ...]
+        self.pending_messages: DefaultDict[str, List[str]] = defaultdict(list)  # jid -> [msg1, msg2, ...]
         self.pending_message_tasks: Dict[str, asyncio.Task] = {}  # jid -> task
-        self.last_user_message_time: Dict[str, float] = {}  # jid -> timestamp
+        self.pending_deadlines: Dict[str, float] = {}  # jid -> time.monotonic() en que se procesa
+
+        # Cola de trabajos de Monday/alertas: se atienden fuera del turno del cliente
+        self.crm_queue: Optional[asyncio.Queue] = None
+        self.crm_worker: Optional[asyncio.Task] = None
+
+        # Tareas fire-and-forget: el loop solo guarda referencias débiles,
+        # así que se retienen aquí hasta que terminan (si no, el GC puede cortarlas)
+        self.background_tasks: Set[asyncio.Task] = set()
+
+    def spawn(self, coro) -> asyncio.Task:
+        """create_task que retiene la tarea hasta que termine."""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
 
 
 # === 3. LIFESPAN (INICIO/CIERRE) ===
@@ -124,10 +195,14 @@ async def lifespan(app: FastAPI):
     bot_state = GlobalState()
 
     # A) Cliente HTTP persistente (Evolution)
+    # HTTP/2 (si el servidor lo negocia por TLS) multiplexa envíos concurrentes en una conexión;
+    # keep-alive largo para no reabrir conexiones entre mensajes.
     bot_state.http_client = httpx.AsyncClient(
         base_url=settings.EVOLUTION_API_URL.rstrip("/"),
         headers={"apikey": settings.EVOLUTION_API_KEY, "Content-Type": "application/json"},
         timeout=30.0,
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60.0),
     )
 
     # B) Inventario
@@ -142,10 +217,18 @@ async def lifespan(app: FastAPI):
 
     try:
         await bot_state.inventory.load(force=True)
+        warm_inventory_indexes(bot_state.inventory)
         count = len(getattr(bot_state.inventory, "items", []) or [])
         logger.info(f"✅ Inventario cargado: {count} items.")
     except Exception as e:
         logger.error(f"⚠️ Error cargando inventario inicial: {e}")
+    bot_state.inventory_refresh_task = asyncio.create_task(_inventory_refresh_loop(bot_state))
+
+    # Financiamiento (fuera del event loop; así el primer PDF no lee disco)
+    try:
+        await load_financing_data()
+    except Exception as e:
+        logger.error(f"⚠️ Error cargando financiamiento: {e}")
 
     # C) Memoria
     bot_state.store = MemoryStore()
@@ -155,17 +238,32 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"⚠️ Error iniciando MemoryStore: {e}")
 
+    # D) Worker de Monday/alertas
+    bot_state.crm_queue = asyncio.Queue()
+    bot_state.crm_worker = asyncio.create_task(_crm_worker(bot_state.crm_queue))
+
     # Inyectar estado en app para acceso desde endpoints
     app.state.bot = bot_state
 
     yield
 
-    # D) Limpieza
+    # E) Limpieza
     logger.info("🛑 Deteniendo aplicación...")
+    await _stop_crm_worker(bot_state)
+    if bot_state.inventory_refresh_task:
+        bot_state.inventory_refresh_task.cancel()
+        try:
+            await bot_state.inventory_refresh_task
+        except asyncio.CancelledError:
+            pass
     if bot_state.store:
         await bot_state.store.close()
+    if bot_state.inventory:
+        await bot_state.inventory.close()
+    await monday_service.close()
     if bot_state.http_client:
         await bot_state.http_client.aclose()
+    await close_openai_client()
     logger.info("👋 Recursos liberados.")
 
 
@@ -173,10 +271,21 @@ app = FastAPI(lifespan=lifespan)
 
 
 # === 4. UTILIDADES ===
+_NON_DIGITS_RE = re.compile(r"[^0-9]+")
+
+
 def _clean_phone_or_jid(value: str) -> str:
     if not value:
         return ""
-    return "".join([c for c in str(value) if c.isdigit()])
+    value = str(value)
+    if value.isascii():
+        # Caso normal (jid de WhatsApp): una pasada del regex en C
+        return _NON_DIGITS_RE.sub("", value)
+    return "".join([c for c in value if c.isdigit()])
+
+
+# Distingue "llave ausente" de "llave con None" con una sola búsqueda en el dict
+_MISSING = object()
 
 
 def _extract_user_message(msg_obj: Dict[str, Any]) -> Tuple[str, bool]:
@@ -187,19 +296,20 @@ def _extract_user_message(msg_obj: Dict[str, Any]) -> Tuple[str, bool]:
     if not isinstance(msg_obj, dict):
         return "", False
 
-    # 1. Mensaje de texto normal
-    if "conversation" in msg_obj:
-        return msg_obj.get("conversation") or "", False
+    # 1. Mensaje de texto normal (el caso más común: una sola búsqueda)
+    text = msg_obj.get("conversation", _MISSING)
+    if text is not _MISSING:
+        return text or "", False
 
     # 2. Mensaje de texto extendido (reply, etc)
-    if "extendedTextMessage" in msg_obj:
-        ext = msg_obj.get("extendedTextMessage") or {}
-        return ext.get("text") or "", False
+    ext = msg_obj.get("extendedTextMessage", _MISSING)
+    if ext is not _MISSING:
+        return (ext or {}).get("text") or "", False
 
     # 3. Imagen con caption
-    if "imageMessage" in msg_obj:
-        img = msg_obj.get("imageMessage") or {}
-        return img.get("caption") or "(Envió una foto)", False
+    img = msg_obj.get("imageMessage", _MISSING)
+    if img is not _MISSING:
+        return (img or {}).get("caption") or "(Envió una foto)", False
 
     # 4. AUDIO/NOTA DE VOZ
     if "audioMessage" in msg_obj or "pttMessage" in msg_obj:
@@ -208,53 +318,127 @@ def _extract_user_message(msg_obj: Dict[str, Any]) -> Tuple[str, bool]:
     return "", False
 
 
-async def _ensure_inventory_loaded(bot_state: GlobalState) -> None:
+async def _inventory_refresh_loop(bot_state: GlobalState) -> None:
     """
-    Compatibilidad con distintas versiones de InventoryService.
+    Refresca el inventario en segundo plano cada INVENTORY_REFRESH_SECONDS.
+    Los turnos solo leen el snapshot en memoria; nunca esperan la descarga del sheet.
+    Solo se recarga si hubo consultas desde el último refresco (de noche / fines de
+    semana no se descarga nada); tras un tick saltado, la primera consulta despierta
+    al loop para refrescar de inmediato. Si el inventario quedó vacío (falló la carga), reintenta antes.
     """
     inv = bot_state.inventory
     if not inv:
         return
-    try:
-        if hasattr(inv, "ensure_loaded"):
-            await inv.ensure_loaded()
-        else:
-            await inv.load(force=False)
-    except Exception as e:
-        logger.error(f"⚠️ No se pudo refrescar inventario: {e}")
+    wake = bot_state.inventory_wake
+    while True:
+        delay = settings.INVENTORY_REFRESH_SECONDS if inv.items else min(30, settings.INVENTORY_REFRESH_SECONDS)
+        try:
+            await asyncio.wait_for(wake.wait(), timeout=delay)
+            logger.info("🔄 Inventario inactivo: refrescando por nueva consulta")
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+        if inv.items and bot_state.inventory_query_count == 0:
+            bot_state.inventory_idle = True
+            continue
+        bot_state.inventory_idle = False
+        bot_state.inventory_query_count = 0
+        try:
+            await inv.load(force=True)
+            warm_inventory_indexes(inv)
+        except Exception as e:
+            logger.error(f"⚠️ No se pudo refrescar inventario: {e}")
 
 
-def _safe_log_payload(prefix: str, obj: Any) -> None:
+# Campos sensibles del payload en una sola alternancia (una pasada sobre el JSON)
+_SENSITIVE_FIELD_RE = re.compile(r'"(apikey|password|token)":\s*"[^"]*"')
+
+
+class _LazyPayload:
     """
-    Log controlado CON SANITIZACIÓN.
+    Payload sanitizado que se serializa recién cuando un handler formatea el registro:
+    si el log se filtra (nivel del handler, etc.) no se hace dump ni sanitización.
     """
-    if not settings.LOG_WEBHOOK_PAYLOAD:
-        return
-    try:
-        raw = json.dumps(obj, ensure_ascii=False)
-        
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        try:
+            raw = orjson.dumps(self.obj).decode()
+        except Exception as e:
+            return f"⚠️ No se pudo loggear payload: {e}"
+
         # 🔒 SANITIZAR información sensible
         raw = raw.replace(settings.EVOLUTION_API_KEY, "***REDACTED***")
-        raw = re.sub(r'"apikey":\s*"[^"]*"', '"apikey": "***"', raw)
-        raw = re.sub(r'"password":\s*"[^"]*"', '"password": "***"', raw)
-        raw = re.sub(r'"token":\s*"[^"]*"', '"token": "***"', raw)
-        
+        raw = _SENSITIVE_FIELD_RE.sub(r'"\1": "***"', raw)
+
         if len(raw) > settings.LOG_WEBHOOK_PAYLOAD_MAX_CHARS:
             raw = raw[: settings.LOG_WEBHOOK_PAYLOAD_MAX_CHARS] + " ...[TRUNCATED]"
-        logger.info(f"{prefix}{raw}")
-    except Exception as e:
-        logger.warning(f"⚠️ No se pudo loggear payload: {e}")
+        return raw
+
+
+def _safe_log_payload(prefix: str, obj: Any) -> None:
+    """
+    Log controlado CON SANITIZACIÓN.
+    """
+    if not settings.LOG_WEBHOOK_PAYLOAD or not logger.isEnabledFor(logging.INFO):
+        return
+    logger.info("%s%s", prefix, _LazyPayload(obj))
+
+
+class _TokenBucket:
+    """
+    Limitador proactivo: como máximo `rate` requests/seg (ráfagas de hasta `rate`).
+    Tras un 429 la tasa baja a la mitad durante `penalty_seconds`.
+    """
+
+    def __init__(self, rate: float, penalty_seconds: float = 60.0):
+        self._rate = max(rate, 0.1)
+        self._tokens = self._rate
+        self._updated = time.monotonic()
+        self._penalty_seconds = penalty_seconds
+        self._penalty_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _current_rate(self, now: float) -> float:
+        return self._rate / 2 if now < self._penalty_until else self._rate
+
+    async def acquire(self) -> None:
+        # El lock mantiene el orden de llegada; quien espera token duerme con el lock tomado
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                rate = self._current_rate(now)
+                self._tokens = min(rate, self._tokens + (now - self._updated) * rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / rate)
+
+    def penalize(self) -> None:
+        self._penalty_until = time.monotonic() + self._penalty_seconds
+
+
+_EVO_RATE_LIMITER = _TokenBucket(settings.EVOLUTION_MAX_RPS)
 
 
 async def _evo_post(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
-    """POST a Evolution API con retry automático en 429 (rate limit)."""
+    """POST a Evolution API con rate limit proactivo y retry automático en 429."""
     _MAX_RETRIES = 3
     for _attempt in range(_MAX_RETRIES):
+        await _EVO_RATE_LIMITER.acquire()
         response = await client.post(url, **kwargs)
         if response.status_code == 429 and _attempt < _MAX_RETRIES - 1:
+            _EVO_RATE_LIMITER.penalize()
             retry_after = response.headers.get("retry-after")
             backoff = int(retry_after) if retry_after and retry_after.isdigit() else 2 ** (_attempt + 1)
-            logger.warning(f"⚠️ Evolution 429 retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff}s")
+            # Jitter para que los reintentos concurrentes no vuelvan a chocar juntos
+            backoff += random.uniform(0, backoff / 2)
+            logger.warning(f"⚠️ Evolution 429 retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff:.1f}s")
             await asyncio.sleep(backoff)
             continue
         return response
@@ -262,34 +446,41 @@ async def _evo_post(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Resp
 
 
 # === 5. 🆕 DETECCIÓN DE MENSAJES HUMANOS ===
+# Rasgos que el bot NUNCA usa (constantes de módulo: no se arman listas por mensaje)
+_HUMAN_EMOJIS = ("😊", "👍", "🙏", "💪", "🚚", "✅", "❤️", "🔥", "👌", "😉", "😅", "🤝", "📞", "📱", "🎉", "💯")
+_HUMAN_PHRASES = (
+    "un momento", "déjame verificar", "déjame revisar", "te marco", "te llamo",
+    "te hablo", "estoy revisando", "dame un segundo", "aquí adrian", "soy adrian",
+    "con adrian", "te contacto", "te escribo", "ahora te", "espérame", "un sec",
+)
+_HUMAN_TYPOS = ("aver", "haber si", "ps si", "nel", "simon", "sisas", "ok ok", "oks")
+
+
 def _message_looks_human(text: str) -> bool:
     """Detecta si un mensaje tiene características que el bot NO usaría."""
     if not text:
         return False
 
-    text_lower = text.lower()
+    # 1. El bot NUNCA usa emojis (un texto ASCII no puede traer ninguno)
+    if not text.isascii():
+        for emoji in _HUMAN_EMOJIS:
+            if emoji in text:
+                logger.debug(f"🔍 Detectado emoji humano en: '{text[:50]}'")
+                return True
 
-    # 1. El bot NUNCA usa emojis
-    emoji_patterns = ["😊", "👍", "🙏", "💪", "🚚", "✅", "❤️", "🔥", "👌", "😉", "😅", "🤝", "📞", "📱", "🎉", "💯"]
-    if any(emoji in text for emoji in emoji_patterns):
-        logger.debug(f"🔍 Detectado emoji humano en: '{text[:50]}'")
-        return True
+    text_lower = text.lower()
 
     # 2. Frases típicas de asesor humano
-    human_phrases = [
-        "un momento", "déjame verificar", "déjame revisar", "te marco", "te llamo",
-        "te hablo", "estoy revisando", "dame un segundo", "aquí adrian", "soy adrian",
-        "con adrian", "te contacto", "te escribo", "ahora te", "espérame", "un sec"
-    ]
-    if any(phrase in text_lower for phrase in human_phrases):
-        logger.debug(f"🔍 Detectada frase humana en: '{text[:50]}'")
-        return True
+    for phrase in _HUMAN_PHRASES:
+        if phrase in text_lower:
+            logger.debug(f"🔍 Detectada frase humana en: '{text[:50]}'")
+            return True
 
     # 3. Errores de ortografía típicamente humanos
-    typos = ["aver", "haber si", "ps si", "nel", "simon", "sisas", "ok ok", "oks"]
-    if any(typo in text_lower for typo in typos):
-        logger.debug(f"🔍 Detectado typo humano en: '{text[:50]}'")
-        return True
+    for typo in _HUMAN_TYPOS:
+        if typo in text_lower:
+            logger.debug(f"🔍 Detectado typo humano en: '{text[:50]}'")
+            return True
 
     return False
 
@@ -303,24 +494,23 @@ def _is_automated_greeting(text: str) -> bool:
         return False
 
     text_lower = text.lower()
+    has_wa_link = "wa.me" in text_lower
 
-    # Patrones de mensajes de bienvenida automáticos
-    automated_patterns = [
+    # Patrones de mensajes de bienvenida automáticos (se evalúan en corto circuito)
+    is_automated = (
         # WhatsApp Business greeting messages
-        ("bienvenido" in text_lower and "wa.me" in text_lower),
-        ("catálogo" in text_lower and "wa.me" in text_lower),
-        ("catalogo" in text_lower and "wa.me" in text_lower),
+        (has_wa_link and ("bienvenido" in text_lower or "catálogo" in text_lower or "catalogo" in text_lower))
         # Links de catálogo de WhatsApp
-        "wa.me/c/" in text_lower,
+        or "wa.me/c/" in text_lower
         # Mensajes de ausencia típicos
-        ("no estamos disponibles" in text_lower),
-        ("fuera de horario" in text_lower),
-        ("te contactaremos" in text_lower and "pronto" in text_lower),
+        or "no estamos disponibles" in text_lower
+        or "fuera de horario" in text_lower
+        or ("te contactaremos" in text_lower and "pronto" in text_lower)
         # Mensajes de bienvenida genéricos sin contexto
-        (text_lower.startswith("hola") and "bienvenido" in text_lower and len(text) < 200),
-    ]
+        or (text_lower.startswith("hola") and "bienvenido" in text_lower and len(text) < 200)
+    )
 
-    if any(automated_patterns):
+    if is_automated:
         logger.info(f"🤖 Mensaje automático detectado (NO silencia): '{text[:80]}...'")
         return True
 
@@ -339,13 +529,16 @@ def _is_bot_message(bot_state: GlobalState, remote_jid: str, msg_id: str, msg_te
     # CAPA 2: Verificar texto exacto reciente
     if remote_jid in bot_state.bot_sent_texts:
         recent_texts = bot_state.bot_sent_texts[remote_jid]
-        if msg_text in recent_texts:
+        if hash(msg_text) in recent_texts:
             logger.debug(f"✓ Texto coincide con cache del bot")
             return True
     
     # CAPA 3: Verificar timestamp (ventana temporal)
-    last_bot_time = bot_state.last_bot_message_time.get(remote_jid, 0)
-    time_diff = time.time() - last_bot_time
+    last_bot_time = bot_state.last_bot_message_time.get(remote_jid)
+    if last_bot_time is None:
+        logger.debug(f"✗ NO es del bot (sin envíos recientes del bot)")
+        return False
+    time_diff = time.monotonic() - last_bot_time
     
     if time_diff < settings.HUMAN_DETECTION_WINDOW_SECONDS:
         logger.debug(f"✓ Dentro de ventana temporal ({time_diff:.1f}s)")
@@ -364,6 +557,16 @@ async def human_typing_delay():
 
 
 # === 6.5 PROCESAMIENTO DE MENSAJES ACUMULADOS ===
+_HANDOFF_ALERT_TMPL = "*HANDOFF ACTIVADO*\n\nEl chat con wa.me/{client} ha sido pausado."
+
+# Nota de Monday por etapa del funnel: (plantilla, campo de funnel_data, default)
+_FUNNEL_STAGE_NOTES: Dict[str, Tuple[str, str, str]] = {
+    "Enganche": ("💬 Cliente interactuando (turno {})", "turn_count", "?"),
+    "Intención": ("🎯 Interesado en: {}", "interes", "N/A"),
+    "Cita agendada": ("✅ Cita confirmada: {}", "cita", "N/A"),
+}
+
+
 async def _process_accumulated_messages(bot_state: GlobalState, remote_jid: str):
     """
     Procesa todos los mensajes acumulados de un usuario como uno solo.
@@ -372,6 +575,7 @@ async def _process_accumulated_messages(bot_state: GlobalState, remote_jid: str)
     # Obtener y limpiar mensajes pendientes
     messages = bot_state.pending_messages.pop(remote_jid, [])
     bot_state.pending_message_tasks.pop(remote_jid, None)
+    bot_state.pending_deadlines.pop(remote_jid, None)
 
     if not messages:
         return
@@ -386,17 +590,19 @@ async def _process_accumulated_messages(bot_state: GlobalState, remote_jid: str)
     # === Verificar silenciamiento ===
     if remote_jid in bot_state.silenced_users:
         silence_value = bot_state.silenced_users[remote_jid]
-        if isinstance(silence_value, (int, float)):
-            if time.time() < silence_value:
-                mins_left = int((silence_value - time.time()) / 60)
+        # True va primero: bool es subclase de int y caería en la rama del plazo
+        if silence_value is True:
+            logger.info(f"🤐 Bot silenciado permanentemente en {remote_jid}")
+            return
+        elif isinstance(silence_value, (int, float)):
+            remaining = silence_value - time.monotonic()
+            if remaining > 0:
+                mins_left = int(remaining / 60)
                 logger.info(f"🤐 Bot silenciado en {remote_jid} ({mins_left} min restantes)")
                 return
             else:
                 del bot_state.silenced_users[remote_jid]
                 logger.info(f"✅ Bot reactivado automáticamente en {remote_jid}")
-        elif silence_value is True:
-            logger.info(f"🤐 Bot silenciado permanentemente en {remote_jid}")
-            return
 
     # === Comandos especiales ===
     if combined_message.lower() == "/silencio":
@@ -404,7 +610,7 @@ async def _process_accumulated_messages(bot_state: GlobalState, remote_jid: str)
         await send_evolution_message(bot_state, remote_jid, "Bot desactivado. Un asesor humano te atenderá en breve.")
         if settings.OWNER_PHONE:
             clean_client = remote_jid.split("@")[0]
-            alerta = f"*HANDOFF ACTIVADO*\n\nEl chat con wa.me/{clean_client} ha sido pausado."
+            alerta = _HANDOFF_ALERT_TMPL.format(client=clean_client)
             await send_evolution_message(bot_state, settings.OWNER_PHONE, alerta)
         return
 
@@ -413,24 +619,28 @@ async def _process_accumulated_messages(bot_state: GlobalState, remote_jid: str)
         await send_evolution_message(bot_state, remote_jid, "Bot activado de nuevo. ¿En qué te ayudo?")
         return
 
-    # === Refrescar inventario ===
-    await _ensure_inventory_loaded(bot_state)
-
     store = bot_state.store
     if not store:
         logger.error("❌ MemoryStore no inicializado.")
         return
 
+    # === Leer la sesión (el inventario se refresca en segundo plano) ===
     session = await store.get(remote_jid) or {"state": "start", "context": {}}
     state = session.get("state", "start")
     context = session.get("context", {}) or {}
 
-    # Delay humano
-    await human_typing_delay()
-
     # === Procesar con IA ===
+    bot_state.inventory_query_count += 1
+    if bot_state.inventory_idle:
+        # El snapshot lleva al menos un ciclo sin refrescarse: despertar al loop ya
+        bot_state.inventory_idle = False
+        bot_state.inventory_wake.set()
+    # La llamada a OpenAI corre mientras pasa el delay humano, en vez de después:
+    # el usuario espera max(delay, IA) y no delay + IA.
+    ai_task = asyncio.ensure_future(handle_message(combined_message, bot_state.inventory, state, context))
+    await human_typing_delay()
     try:
-        result = await handle_message(combined_message, bot_state.inventory, state, context)
+        result = await ai_task
     except Exception as e:
         logger.error(f"❌ Error IA: {e}")
         result = {
@@ -459,15 +669,15 @@ async def _process_accumulated_messages(bot_state: GlobalState, remote_jid: str)
     # Verificar si hay que enviar un PDF
     if pdf_info:
         logger.info(f"📄 PDF info recibido: {pdf_info}")
-        if pdf_info.get("pdf_url"):
+        if pdf_info.pdf_url:
             # Enviar texto + PDF
-            logger.info(f"📤 Enviando PDF: {pdf_info.get('filename')} -> {remote_jid}")
+            logger.info(f"📤 Enviando PDF: {pdf_info.filename} -> {remote_jid}")
             await send_evolution_document(
                 bot_state,
                 remote_jid,
                 reply_text,
-                pdf_info.get("pdf_url"),
-                pdf_info.get("filename", "documento.pdf")
+                pdf_info.pdf_url,
+                pdf_info.filename or "documento.pdf"
             )
         else:
             # PDF detectado pero no disponible - enviar solo texto
@@ -502,15 +712,21 @@ async def _process_accumulated_messages(bot_state: GlobalState, remote_jid: str)
                     "pago": funnel_data.get("pago"),
                 }
 
-                stage_notes = {
-                    "Enganche": f"💬 Cliente interactuando (turno {funnel_data.get('turn_count', '?')})",
-                    "Intención": f"🎯 Interesado en: {funnel_data.get('interes', 'N/A')}",
-                    "Cita agendada": f"✅ Cita confirmada: {funnel_data.get('cita', 'N/A')}",
-                }
-                note = stage_notes.get(funnel_stage)
+                note = None
+                stage_note = _FUNNEL_STAGE_NOTES.get(funnel_stage)
+                if stage_note:
+                    tmpl, field, default = stage_note
+                    note = tmpl.format(funnel_data.get(field, default))
 
                 logger.info(f"📊 FUNNEL [{funnel_stage}]: {lead_data.get('telefono')} - {lead_data.get('interes')}")
-                await monday_service.create_or_update_lead(lead_data, stage=funnel_stage, add_note=note)
+                _enqueue_crm_job(
+                    bot_state,
+                    "actualizando funnel en Monday",
+                    monday_service.create_or_update_lead,
+                    lead_data,
+                    stage=funnel_stage,
+                    add_note=note,
+                )
 
         except Exception as e:
             logger.error(f"❌ Error actualizando funnel en Monday: {e}")
@@ -521,23 +737,36 @@ async def _process_accumulated_messages(bot_state: GlobalState, remote_jid: str)
             lead_key = f"{remote_jid}|lead"
             if lead_key not in bot_state.processed_lead_ids:
                 bot_state.processed_lead_ids.add(lead_key)
-                await notify_owner(bot_state, remote_jid, combined_message, reply_text, is_lead=True)
+                _enqueue_crm_job(
+                    bot_state,
+                    "procesando LEAD calificado",
+                    notify_owner, bot_state, remote_jid, combined_message, reply_text, is_lead=True,
+                )
         except Exception as e:
             logger.error(f"❌ Error procesando LEAD calificado: {e}")
     else:
-        await notify_owner(bot_state, remote_jid, combined_message, reply_text, is_lead=False)
+        _enqueue_crm_job(
+            bot_state,
+            "notificando al dueño",
+            notify_owner, bot_state, remote_jid, combined_message, reply_text, is_lead=False,
+        )
 
 
 async def _schedule_accumulated_processing(bot_state: GlobalState, remote_jid: str):
     """
-    Espera MESSAGE_ACCUMULATION_SECONDS y luego procesa los mensajes acumulados.
-    Si llegan más mensajes, esta tarea se cancela y se crea una nueva.
+    Espera a que pasen MESSAGE_ACCUMULATION_SECONDS sin mensajes nuevos y luego procesa
+    los acumulados. Cada mensaje nuevo solo corre pending_deadlines[jid]; esta misma
+    tarea vuelve a dormir hasta el nuevo plazo (no se cancela ni se crea otra).
     """
     try:
-        await asyncio.sleep(settings.MESSAGE_ACCUMULATION_SECONDS)
+        while True:
+            remaining = bot_state.pending_deadlines.get(remote_jid, 0.0) - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
         await _process_accumulated_messages(bot_state, remote_jid)
     except asyncio.CancelledError:
-        # Se canceló porque llegó otro mensaje - normal
+        # Apagado de la app
         pass
     except Exception as e:
         logger.error(f"❌ Error en procesamiento acumulado: {e}")
@@ -552,11 +781,7 @@ async def _handle_audio_transcription(bot_state: GlobalState, msg_id: str, remot
         logger.warning("⚠️ msg_id o remote_jid vacío")
         return ""
 
-    temp_path = None
     try:
-        with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as temp_audio:
-            temp_path = temp_audio.name
-
         logger.info(f"⬇️ Descargando audio desde Evolution API...")
 
         client = bot_state.http_client
@@ -583,7 +808,7 @@ async def _handle_audio_transcription(bot_state: GlobalState, msg_id: str, remot
             logger.error(f"❌ Error descargando desde Evolution: {response.status_code}")
             return ""
 
-        data = response.json()
+        data = orjson.loads(response.content)
 
         if isinstance(data, dict):
             base64_audio = data.get("base64") or data.get("media")
@@ -595,22 +820,17 @@ async def _handle_audio_transcription(bot_state: GlobalState, msg_id: str, remot
             return ""
 
         audio_bytes = base64.b64decode(base64_audio)
-        
-        with open(temp_path, "wb") as f:
-            f.write(audio_bytes)
 
         logger.info(f"✅ Audio descargado: {len(audio_bytes)} bytes")
 
         try:
-            from src.conversation_logic import client as openai_client
-
-            with open(temp_path, "rb") as audio_file:
-                transcript = await openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="es",
-                    response_format="text"
-                )
+            # Los bytes van directo al multipart; el nombre le indica el formato a Whisper
+            transcript = await openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=("audio.ogg", audio_bytes),
+                language="es",
+                response_format="text"
+            )
             
             if isinstance(transcript, str):
                 texto = transcript.strip()
@@ -632,14 +852,6 @@ async def _handle_audio_transcription(bot_state: GlobalState, msg_id: str, remot
         logger.error(f"❌ Error general procesando audio: {e}")
         return ""
 
-    finally:
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-                logger.info(f"🗑️ Archivo temporal eliminado")
-            except Exception as e:
-                logger.warning(f"⚠️ No se pudo eliminar temp file: {e}")
-
 
 # === 8. ENVÍO DE MENSAJES (CON RASTREO) ===
 async def send_evolution_message(bot_state: GlobalState, number_or_jid: str, text: str, media_urls: Optional[List[str]] = None):
@@ -662,18 +874,19 @@ async def send_evolution_message(bot_state: GlobalState, number_or_jid: str, tex
     try:
         if media_urls:
             total_fotos = len(media_urls)
+            url = f"/message/sendMedia/{settings.EVO_INSTANCE}"
+            # Un solo payload: por foto solo cambian caption y media
+            # (httpx serializa el JSON al armar el request, así que se puede reutilizar)
+            payload = {
+                "number": clean_number,
+                "mediatype": "image",
+                "mimetype": "image/jpeg",
+                "caption": "",
+                "media": "",
+            }
             for i, media_url in enumerate(media_urls):
-                url = f"/message/sendMedia/{settings.EVO_INSTANCE}"
-                
-                caption_part = text if (i == total_fotos - 1) else ""
-                
-                payload = {
-                    "number": clean_number,
-                    "mediatype": "image",
-                    "mimetype": "image/jpeg",
-                    "caption": caption_part,
-                    "media": media_url,
-                }
+                payload["caption"] = text if (i == total_fotos - 1) else ""
+                payload["media"] = media_url
                 
                 if i > 0:
                     await asyncio.sleep(0.5)
@@ -686,7 +899,7 @@ async def send_evolution_message(bot_state: GlobalState, number_or_jid: str, tex
                     logger.info(f"✅ Enviada foto {i+1}/{total_fotos} a {clean_number}")
                     
                     try:
-                        resp_data = response.json()
+                        resp_data = orjson.loads(response.content)
                         msg_id = resp_data.get("key", {}).get("id")
                         if msg_id:
                             bot_state.bot_sent_message_ids.add(msg_id)
@@ -706,7 +919,7 @@ async def send_evolution_message(bot_state: GlobalState, number_or_jid: str, tex
                 jid = f"{clean_number}@s.whatsapp.net"
                 
                 try:
-                    resp_data = response.json()
+                    resp_data = orjson.loads(response.content)
                     msg_id = resp_data.get("key", {}).get("id")
                     if msg_id:
                         bot_state.bot_sent_message_ids.add(msg_id)
@@ -714,11 +927,17 @@ async def send_evolution_message(bot_state: GlobalState, number_or_jid: str, tex
                 except Exception:
                     pass
 
-                if jid not in bot_state.bot_sent_texts:
-                    bot_state.bot_sent_texts[jid] = deque(maxlen=10)
-                bot_state.bot_sent_texts[jid].append(text)
+                text_hash = hash(text)
+                recent_texts = bot_state.bot_sent_texts.get(jid)
+                if recent_texts is None:
+                    recent_texts = {}
+                bot_state.bot_sent_texts[jid] = recent_texts  # marca el chat como reciente
+                recent_texts.pop(text_hash, None)  # reenviado: pasa a ser el más reciente
+                recent_texts[text_hash] = None
+                if len(recent_texts) > _BOT_SENT_TEXTS_PER_CHAT:
+                    del recent_texts[next(iter(recent_texts))]
                 
-                bot_state.last_bot_message_time[jid] = time.time()
+                bot_state.last_bot_message_time[jid] = time.monotonic()
 
     except httpx.RequestError as e:
         logger.error(f"❌ Error de conexión: {e}")
@@ -726,10 +945,15 @@ async def send_evolution_message(bot_state: GlobalState, number_or_jid: str, tex
         logger.error(f"❌ Error inesperado: {e}")
 
 
+# Largo máximo de caption que WhatsApp muestra completo en un documento
+_DOC_CAPTION_MAX_CHARS = 1024
+
+
 async def send_evolution_document(bot_state: GlobalState, number_or_jid: str, text: str, pdf_url: str, filename: str):
     """
-    Envía primero un mensaje de texto y luego un PDF como documento.
-    El texto se envía antes del PDF para dar contexto al usuario.
+    Envía un PDF como documento con el texto como caption (una sola llamada).
+    Si el texto no cabe en el caption, se envía antes del PDF como mensaje aparte
+    para dar contexto al usuario.
     """
     clean_number = _clean_phone_or_jid(number_or_jid)
     if not clean_number:
@@ -741,9 +965,11 @@ async def send_evolution_document(bot_state: GlobalState, number_or_jid: str, te
         logger.error("❌ Cliente HTTP no inicializado (lifespan).")
         return
 
+    caption = text if text and len(text) <= _DOC_CAPTION_MAX_CHARS else ""
+
     try:
-        # 1. Enviar texto primero
-        if text:
+        # 1. Texto largo: enviarlo primero como mensaje aparte
+        if text and not caption:
             url_text = f"/message/sendText/{settings.EVO_INSTANCE}"
             payload_text = {"number": clean_number, "text": text}
             response = await _evo_post(client, url_text, json=payload_text)
@@ -753,7 +979,7 @@ async def send_evolution_document(bot_state: GlobalState, number_or_jid: str, te
             else:
                 logger.info(f"✅ Texto enviado antes de PDF a {clean_number}")
                 try:
-                    resp_data = response.json()
+                    resp_data = orjson.loads(response.content)
                     msg_id = resp_data.get("key", {}).get("id")
                     if msg_id:
                         bot_state.bot_sent_message_ids.add(msg_id)
@@ -771,7 +997,7 @@ async def send_evolution_document(bot_state: GlobalState, number_or_jid: str, te
             "mimetype": "application/pdf",
             "media": pdf_url,
             "fileName": filename,
-            "caption": ""
+            "caption": caption
         }
 
         response = await _evo_post(client, url_media, json=payload_pdf)
@@ -781,7 +1007,7 @@ async def send_evolution_document(bot_state: GlobalState, number_or_jid: str, te
         else:
             logger.info(f"✅ PDF enviado a {clean_number}: {filename}")
             try:
-                resp_data = response.json()
+                resp_data = orjson.loads(response.content)
                 msg_id = resp_data.get("key", {}).get("id")
                 if msg_id:
                     bot_state.bot_sent_message_ids.add(msg_id)
@@ -795,6 +1021,29 @@ async def send_evolution_document(bot_state: GlobalState, number_or_jid: str, te
 
 
 # === 9. ALERTAS AL DUEÑO ===
+_LEAD_ALERT_TMPL = (
+    "*NUEVO LEAD EN MONDAY*\n\n"
+    "Cliente: wa.me/{client}\n"
+    "El bot cerró una cita. Revisa el tablero."
+)
+
+# Palabras que disparan la alerta de interés ("info" ya cubre "informes")
+_OWNER_ALERT_KEYWORDS = (
+    "precio", "cuanto", "cuánto", "interesa", "verlo", "ubicacion", "ubicación",
+    "dónde", "donde", "trato", "comprar", "info",
+)
+
+
+def _message_shows_interest(text: str) -> bool:
+    if not text:
+        return False
+    text_lower = text.lower()
+    for word in _OWNER_ALERT_KEYWORDS:
+        if word in text_lower:
+            return True
+    return False
+
+
 async def notify_owner(bot_state: GlobalState, user_number_or_jid: str, user_message: str, bot_reply: str, is_lead: bool = False):
     if not settings.OWNER_PHONE:
         return
@@ -802,21 +1051,11 @@ async def notify_owner(bot_state: GlobalState, user_number_or_jid: str, user_mes
     clean_client = _clean_phone_or_jid(user_number_or_jid)
 
     if is_lead:
-        alert_text = (
-            "*NUEVO LEAD EN MONDAY*\n\n"
-            f"Cliente: wa.me/{clean_client}\n"
-            "El bot cerró una cita. Revisa el tablero."
-        )
+        alert_text = _LEAD_ALERT_TMPL.format(client=clean_client)
         await send_evolution_message(bot_state, settings.OWNER_PHONE, alert_text)
         return
 
-    keywords = [
-        "precio", "cuanto", "cuánto", "interesa", "verlo", "ubicacion", "ubicación",
-        "dónde", "donde", "trato", "comprar", "informes", "info"
-    ]
-
-    msg_lower = (user_message or "").lower()
-    if not any(word in msg_lower for word in keywords):
+    if not _message_shows_interest(user_message):
         return
 
     alert_text = (
@@ -828,21 +1067,66 @@ async def notify_owner(bot_state: GlobalState, user_number_or_jid: str, user_mes
     await send_evolution_message(bot_state, settings.OWNER_PHONE, alert_text)
 
 
+# === 9.5 COLA DE MONDAY / ALERTAS (SEGUNDO PLANO) ===
+# Monday (varias llamadas GraphQL por lead) y las alertas al dueño no afectan la respuesta
+# al cliente: se encolan y un solo worker las atiende en orden, sin que el turno las espere
+# y sin ráfagas de llamadas concurrentes a Monday.
+async def _run_crm_job(label: str, fn, args, kwargs) -> None:
+    try:
+        await fn(*args, **kwargs)
+    except Exception as e:
+        logger.error(f"❌ Error {label}: {e}")
+
+
+async def _crm_worker(queue: asyncio.Queue) -> None:
+    while True:
+        job = await queue.get()
+        try:
+            await _run_crm_job(*job)
+        finally:
+            queue.task_done()
+
+
+def _enqueue_crm_job(bot_state: GlobalState, label: str, fn, *args, **kwargs) -> None:
+    queue = bot_state.crm_queue
+    if queue is None:
+        # Sin worker (p. ej. fuera del lifespan): igual no bloquear el turno
+        bot_state.spawn(_run_crm_job(label, fn, args, kwargs))
+        return
+    queue.put_nowait((label, fn, args, kwargs))
+
+
+async def _stop_crm_worker(bot_state: GlobalState, timeout: float = 10.0) -> None:
+    """Vacía la cola pendiente (con límite de tiempo) y detiene el worker."""
+    queue, worker = bot_state.crm_queue, bot_state.crm_worker
+    if queue is None or worker is None:
+        return
+    try:
+        await asyncio.wait_for(queue.join(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ {queue.qsize()} trabajos de Monday/alertas sin enviar al cerrar")
+    worker.cancel()
+    try:
+        await worker
+    except asyncio.CancelledError:
+        pass
+    bot_state.crm_queue = None
+    bot_state.crm_worker = None
+
+
 # === 10. PROCESADOR CENTRAL ===
 async def process_single_event(bot_state: GlobalState, data: Dict[str, Any]):
     key = data.get("key", {}) or {}
     remote_jid = (key.get("remoteJid", "") or "").strip()
-    from_me = key.get("fromMe", False)
-    msg_id = (key.get("id", "") or "").strip()
 
-    if not remote_jid:
+    # Ignorar grupos/broadcast antes de cualquier otro trabajo (incluido el log)
+    if not remote_jid or remote_jid.endswith(("@g.us", "@broadcast")):
         return
 
-    logger.info(f"📩 Evento: msg_id={msg_id[:20]}... from_me={from_me}")
+    from_me = key.get("fromMe", False)
+    msg_id = (key.get("id", "") or "").strip()
 
-    # Ignorar grupos/broadcast
-    if remote_jid.endswith("@g.us") or "broadcast" in remote_jid:
-        return
+    logger.info(f"📩 Evento: msg_id={msg_id[:20]}... from_me={from_me}")
 
     # Deduplicación por msg_id
     if msg_id and msg_id in bot_state.processed_message_ids:
@@ -873,7 +1157,7 @@ async def process_single_event(bot_state: GlobalState, data: Dict[str, Any]):
 
         # 3. Si NO es del bot Y NO es automático → Es un HUMANO → SILENCIAR
         logger.info(f"🤐 HUMANO DETECTADO en {remote_jid} - silenciando bot por {settings.AUTO_REACTIVATE_MINUTES} min")
-        bot_state.silenced_users[remote_jid] = time.time() + (settings.AUTO_REACTIVATE_MINUTES * 60)
+        bot_state.silenced_users[remote_jid] = time.monotonic() + (settings.AUTO_REACTIVATE_MINUTES * 60)
         return
 
     # === EXTRACCIÓN DE MENSAJE (TEXTO O AUDIO) ===
@@ -902,22 +1186,23 @@ async def process_single_event(bot_state: GlobalState, data: Dict[str, Any]):
     # En lugar de procesar inmediatamente, acumulamos y esperamos
     # para ver si el cliente envía más mensajes seguidos
 
-    # Agregar mensaje a la lista pendiente
-    if remote_jid not in bot_state.pending_messages:
-        bot_state.pending_messages[remote_jid] = []
-    bot_state.pending_messages[remote_jid].append(user_message)
+    # Agregar mensaje a la lista pendiente (defaultdict: un solo lookup)
+    pending = bot_state.pending_messages[remote_jid]
+    pending.append(user_message)
 
-    logger.info(f"📥 Mensaje acumulado ({len(bot_state.pending_messages[remote_jid])} pendientes): '{user_message[:50]}...'")
+    logger.info(f"📥 Mensaje acumulado ({len(pending)} pendientes): '{user_message[:50]}...'")
 
-    # Cancelar tarea anterior si existe (reinicia el timer)
-    if remote_jid in bot_state.pending_message_tasks:
-        old_task = bot_state.pending_message_tasks[remote_jid]
-        if not old_task.done():
-            old_task.cancel()
-            logger.debug(f"⏱️ Timer reiniciado para {remote_jid}")
+    # Reiniciar el timer: correr el plazo; la tarea que ya espera lo vuelve a leer
+    bot_state.pending_deadlines[remote_jid] = time.monotonic() + settings.MESSAGE_ACCUMULATION_SECONDS
 
-    # Programar nuevo procesamiento después de MESSAGE_ACCUMULATION_SECONDS
-    task = asyncio.create_task(_schedule_accumulated_processing(bot_state, remote_jid))
+    pending_task = bot_state.pending_message_tasks.get(remote_jid)
+    if pending_task is not None and not pending_task.done():
+        logger.debug(f"⏱️ Timer reiniciado para {remote_jid}")
+        return
+
+    # Programar procesamiento después de MESSAGE_ACCUMULATION_SECONDS
+    # (spawn la retiene: _process_accumulated_messages la saca de pending_message_tasks al arrancar)
+    task = bot_state.spawn(_schedule_accumulated_processing(bot_state, remote_jid))
     bot_state.pending_message_tasks[remote_jid] = task
 
 
@@ -941,8 +1226,7 @@ async def health(request: Request):
     }
 
 
-async def _background_process_events(bot_state: GlobalState, events: List[Dict[str, Any]]):
-    """Procesa eventos en background para ACK inmediato al webhook."""
+async def _process_events_in_order(bot_state: GlobalState, events: List[Dict[str, Any]]):
     for event in events:
         try:
             await process_single_event(bot_state, event)
@@ -950,15 +1234,34 @@ async def _background_process_events(bot_state: GlobalState, events: List[Dict[s
             logger.error(f"❌ Error procesando evento en background: {e}")
 
 
+async def _background_process_events(bot_state: GlobalState, events: List[Dict[str, Any]]):
+    """
+    Procesa eventos en background para ACK inmediato al webhook.
+    Chats distintos van en paralelo; los eventos de un mismo chat se procesan
+    en orden para no revolver sus mensajes.
+    """
+    if len(events) == 1:
+        await _process_events_in_order(bot_state, events)
+        return
+
+    by_chat: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for event in events:
+        key = (event.get("key") or {}) if isinstance(event, dict) else {}
+        by_chat[key.get("remoteJid") or ""].append(event)
+
+    await asyncio.gather(*(_process_events_in_order(bot_state, chat_events) for chat_events in by_chat.values()))
+
+
 @app.post("/webhook")
-async def evolution_webhook(request: Request):
+async def evolution_webhook(request: Request, background_tasks: BackgroundTasks):
     """
     Webhook anti-reintentos:
-    - SIEMPRE responde 200 rápido (ACK inmediato)
-    - Procesa en background para que Evolution no reintente
+    - SIEMPRE responde 2xx rápido (202 Accepted como ACK inmediato)
+    - Procesa en background (BackgroundTasks, después de enviar la respuesta)
+      para que Evolution no reintente
     """
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
     except Exception as e:
         logger.error(f"❌ webhook: JSON inválido: {e}")
         return {"status": "ignored", "reason": "invalid_json"}
@@ -973,10 +1276,10 @@ async def evolution_webhook(request: Request):
 
         events = data_payload if isinstance(data_payload, list) else [data_payload]
 
-        # ACK inmediato: dispara background y regresa
+        # ACK inmediato: FastAPI corre el procesamiento al terminar de enviar la respuesta
         bot_state: GlobalState = request.app.state.bot
-        asyncio.create_task(_background_process_events(bot_state, events))
-        return {"status": "accepted"}
+        background_tasks.add_task(_background_process_events, bot_state, events)
+        return JSONResponse({"status": "accepted"}, status_code=202)
 
     except Exception as e:
         logger.error(f"❌ webhook ERROR GENERAL: {e}")
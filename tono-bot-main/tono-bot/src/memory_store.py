@@ -1,19 +1,46 @@
+import asyncio
 import aiosqlite
 from datetime import datetime
 from typing import Optional, Dict, Any
-import json
+import orjson
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 DB_PATH = os.getenv("SQLITE_PATH", "/app/tono-bot/db/memory.db")
 
+# Los upserts no hacen commit uno por uno: un flusher en segundo plano
+# junta lo pendiente y hace un solo commit (fsync) cada tanto.
+COMMIT_INTERVAL_SECONDS = 0.2
+
+# SQL del hot path como constantes: mismo texto siempre -> sqlite3 reutiliza
+# el statement ya preparado de su cache en lugar de volver a compilarlo
+_SQL_GET = "SELECT phone, state, context_json FROM sessions WHERE phone=?"
+_SQL_UPSERT = """
+INSERT INTO sessions(phone, state, context_json, updated_at)
+VALUES(?, ?, ?, ?)
+ON CONFLICT(phone) DO UPDATE SET
+    state=excluded.state,
+    context_json=excluded.context_json,
+    updated_at=excluded.updated_at
+"""
+
 class MemoryStore:
+    __slots__ = ("path", "_conn", "_dirty", "_flusher")
+
     def __init__(self, path: str = DB_PATH):
         self.path = path
         self._conn: Optional[aiosqlite.Connection] = None
+        self._dirty = False
+        self._flusher: Optional[asyncio.Task] = None
 
     async def init(self):
         os.makedirs(os.path.dirname(self.path), exist_ok=True)
-        self._conn = await aiosqlite.connect(self.path)
+        self._conn = await aiosqlite.connect(self.path, cached_statements=128)
+        await self._conn.execute("PRAGMA journal_mode=WAL")
+        await self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.row_factory = aiosqlite.Row
         await self._conn.execute("""
         CREATE TABLE IF NOT EXISTS sessions (
             phone TEXT PRIMARY KEY,
@@ -23,37 +50,53 @@ class MemoryStore:
         )
         """)
         await self._conn.commit()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(COMMIT_INTERVAL_SECONDS)
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"❌ Error haciendo commit en MemoryStore: {e}")
+
+    async def _flush(self):
+        if not self._dirty or not self._conn:
+            return
+        self._dirty = False
+        try:
+            await self._conn.commit()
+        except Exception:
+            self._dirty = True
+            raise
 
     async def get(self, phone: str) -> Optional[Dict[str, Any]]:
-        self._conn.row_factory = aiosqlite.Row
-        cursor = await self._conn.execute(
-            "SELECT phone, state, context_json FROM sessions WHERE phone=?", (phone,)
-        )
+        cursor = await self._conn.execute(_SQL_GET, (phone,))
         row = await cursor.fetchone()
-        self._conn.row_factory = None
         if not row:
             return None
         data = dict(row)
         try:
-            data["context"] = json.loads(data["context_json"] or "{}")
+            data["context"] = orjson.loads(data["context_json"] or "{}")
         except Exception:
             data["context"] = {}
         return data
 
     async def upsert(self, phone: str, state: str, context: Dict[str, Any]):
         now = datetime.utcnow().isoformat()
-        ctx_json = json.dumps(context, ensure_ascii=False)
-        await self._conn.execute("""
-        INSERT INTO sessions(phone, state, context_json, updated_at)
-        VALUES(?, ?, ?, ?)
-        ON CONFLICT(phone) DO UPDATE SET
-            state=excluded.state,
-            context_json=excluded.context_json,
-            updated_at=excluded.updated_at
-        """, (phone, state, ctx_json, now))
-        await self._conn.commit()
+        ctx_json = orjson.dumps(context, option=orjson.OPT_NON_STR_KEYS).decode()
+        await self._conn.execute(_SQL_UPSERT, (phone, state, ctx_json, now))
+        self._dirty = True
 
     async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._flusher = None
         if self._conn:
+            await self._flush()
             await self._conn.close()
             self._conn = None
@@ -1,12 +1,16 @@
 import os
 import asyncio
+import random
 import httpx
-import json
 import logging
 import re
+import time
 from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+from zoneinfo import ZoneInfo
 
-import pytz
+import orjson
 
 logger = logging.getLogger(__name__)
 
@@ -17,19 +21,105 @@ MESES_ES = {
     9: "SEPTIEMBRE", 10: "OCTUBRE", 11: "NOVIEMBRE", 12: "DICIEMBRE"
 }
 
+# Sin base de zonas horarias cae a la hora local del servidor (datetime.now(None))
+try:
+    _MX_TZ = ZoneInfo("America/Mexico_City")
+except Exception:
+    _MX_TZ = None
+
+# Los grupos del tablero casi nunca cambian: cachear el ID resuelto por 6 horas
+_GROUP_ID_TTL_SECONDS = 6 * 60 * 60
+
+# Grupo del mes en curso (nombre + ID) se recalcula a lo más una vez por hora
+_CURRENT_GROUP_TTL_SECONDS = 60 * 60
+
+# teléfono -> item_id de Monday: estable mientras viva el lead, se evita la búsqueda por 1 hora
+_ITEM_ID_TTL_SECONDS = 60 * 60
+_ITEM_ID_CACHE_MAX = 10_000
+
+# Tope de espera entre reintentos aunque Monday pida más en Retry-After
+_MAX_BACKOFF_SECONDS = 30.0
+
+# Mismo criterio que _clean_phone_or_jid en main.py: regex compilado para ASCII
+_NON_DIGITS_RE = re.compile(r"[^0-9]+")
+_NON_DIGIT_UNICODE_RE = re.compile(r"\D")
+
+
+@lru_cache(maxsize=4)
+def _month_group_label(year: int, month: int) -> str:
+    return f"{MESES_ES.get(month, '')} {year}"
+
 
 def _get_current_month_group_name() -> str:
     """Retorna el nombre del grupo del mes actual: 'FEBRERO 2026'"""
-    try:
-        tz = pytz.timezone("America/Mexico_City")
-        now = datetime.now(tz)
-    except Exception:
-        now = datetime.now()
+    now = datetime.now(_MX_TZ)
+    return _month_group_label(now.year, now.month)
+
+
+# --- Documentos GraphQL (constantes de módulo, no se rearman por llamada) ---
+
+_Q_FIND_ITEM_BY_PHONE = """
+query ($board_id: ID!, $col_id: String!, $val: String!) {
+  items_page_by_column_values(
+    limit: 1,
+    board_id: $board_id,
+    columns: [{column_id: $col_id, column_values: [$val]}]
+  ) {
+    items { id name }
+  }
+}
+"""
+
+_Q_BOARD_GROUPS = """
+query ($board_id: ID!) {
+  boards(ids: [$board_id]) {
+    groups {
+      id
+      title
+    }
+  }
+}
+"""
+
+_Q_CREATE_ITEM_IN_GROUP = """
+mutation ($board_id: ID!, $group_id: String!, $name: String!, $vals: JSON!) {
+    create_item (board_id: $board_id, group_id: $group_id, item_name: $name, column_values: $vals) { id }
+}
+"""
+
+_Q_CREATE_ITEM = """
+mutation ($board_id: ID!, $name: String!, $vals: JSON!) {
+    create_item (board_id: $board_id, item_name: $name, column_values: $vals) { id }
+}
+"""
+
+_Q_UPDATE_COLUMNS_AND_NOTE = """
+mutation ($item_id: ID!, $board_id: ID!, $vals: JSON!, $body: String!) {
+    cols: change_multiple_column_values (item_id: $item_id, board_id: $board_id, column_values: $vals) { id }
+    note: create_update (item_id: $item_id, body: $body) { id }
+}
+"""
+
+_Q_UPDATE_COLUMNS = """
+mutation ($item_id: ID!, $board_id: ID!, $vals: JSON!) {
+    change_multiple_column_values (item_id: $item_id, board_id: $board_id, column_values: $vals) { id }
+}
+"""
+
+_Q_CREATE_NOTE = """
+mutation ($item_id: ID!, $body: String!) {
+    create_update (item_id: $item_id, body: $body) { id }
+}
+"""
 
-    mes = MESES_ES.get(now.month, "")
-    return f"{mes} {now.year}"
 
 class MondayService:
+    __slots__ = (
+        "api_key", "board_id", "api_url",
+        "phone_dedupe_col_id", "last_msg_id_col_id", "phone_real_col_id", "stage_col_id",
+        "_http", "_group_id_cache", "_current_group_cache", "_item_id_cache", "_item_names",
+    )
+
     def __init__(self):
         self.api_key = os.getenv("MONDAY_API_KEY")
         self.board_id = os.getenv("MONDAY_BOARD_ID")
@@ -48,6 +138,21 @@ class MondayService:
         # 4. Columna STATUS para etapa del funnel
         self.stage_col_id = os.getenv("MONDAY_STAGE_COLUMN_ID")
 
+        # Cliente HTTP compartido (keep-alive: sin handshake TLS nuevo por cada mutation)
+        self._http: httpx.AsyncClient | None = None
+
+        # "board_id:NOMBRE_GRUPO" -> (group_id, expira_en)
+        self._group_id_cache: Dict[str, Tuple[str, float]] = {}
+
+        # (nombre_grupo_mes, group_id, expira_en)
+        self._current_group_cache: Tuple[str, Optional[str], float] = ("", None, 0.0)
+
+        # phone_limpio -> (item_id, expira_en)
+        self._item_id_cache: Dict[str, Tuple[str, float]] = {}
+
+        # item_id -> nombre del item ya escrito en Monday (evita renombrar en cada update)
+        self._item_names: Dict[str, str] = {}
+
         # Log de configuración
         if self.stage_col_id:
             logger.info(f"✅ Monday Stage Column configurada: {self.stage_col_id}")
@@ -61,28 +166,49 @@ class MondayService:
         Ej: "+52 1 55..." -> "52155..."
         """
         if not phone: return ""
-        return re.sub(r'\D', '', str(phone))
+        phone = str(phone)
+        if phone.isascii():
+            return _NON_DIGITS_RE.sub("", phone)
+        return _NON_DIGIT_UNICODE_RE.sub("", phone)
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=25.0,
+                headers={"Authorization": self.api_key, "Content-Type": "application/json"},
+                limits=httpx.Limits(max_connections=40, max_keepalive_connections=20),
+                http2=True,
+            )
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
     async def _graphql(self, query: str, variables: dict):
         if not self.api_key:
             raise RuntimeError("MONDAY_API_KEY no configurada")
 
-        headers = {"Authorization": self.api_key, "Content-Type": "application/json"}
-        payload = {"query": query, "variables": variables}
+        body = orjson.dumps({"query": query, "variables": variables})
+        client = self._client()
 
         _MAX_RETRIES = 3
         for _attempt in range(_MAX_RETRIES):
             try:
-                async with httpx.AsyncClient(timeout=25.0) as client:
-                    resp = await client.post(self.api_url, json=payload, headers=headers)
-
-                if resp.status_code >= 500 and _attempt < _MAX_RETRIES - 1:
-                    backoff = 2 ** (_attempt + 1)
-                    logger.warning(f"⚠️ Monday 5xx retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff}s: {resp.status_code}")
+                resp = await client.post(self.api_url, content=body)
+
+                if (resp.status_code == 429 or resp.status_code >= 500) and _attempt < _MAX_RETRIES - 1:
+                    retry_after = resp.headers.get("retry-after")
+                    backoff = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** (_attempt + 1)
+                    # Jitter para que los reintentos de varios leads en paralelo no vuelvan a chocar juntos
+                    backoff += random.uniform(0, backoff / 4)
+                    backoff = min(max(backoff, 1.0), _MAX_BACKOFF_SECONDS)
+                    logger.warning(f"⚠️ Monday {resp.status_code} retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff:.1f}s")
                     await asyncio.sleep(backoff)
                     continue
 
-                data = resp.json()
+                data = orjson.loads(resp.content)
                 if "errors" in data:
                     logger.error(f"Monday API Error: {data['errors']}")
                 return data
@@ -90,7 +216,8 @@ class MondayService:
             except (httpx.TimeoutException, httpx.RequestError) as e:
                 if _attempt < _MAX_RETRIES - 1:
                     backoff = 2 ** (_attempt + 1)
-                    logger.warning(f"⚠️ Monday retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff}s: {e}")
+                    backoff += random.uniform(0, backoff / 4)
+                    logger.warning(f"⚠️ Monday retry {_attempt + 1}/{_MAX_RETRIES} tras {backoff:.1f}s: {e}")
                     await asyncio.sleep(backoff)
                 else:
                     raise
@@ -101,48 +228,46 @@ class MondayService:
             return None
 
         # Usamos items_page_by_column_values para la API 2023-10+
-        query = """
-        query ($board_id: ID!, $col_id: String!, $val: String!) {
-          items_page_by_column_values(
-            limit: 1,
-            board_id: $board_id,
-            columns: [{column_id: $col_id, column_values: [$val]}]
-          ) {
-            items { id name }
-          }
-        }
-        """
         variables = {
             "board_id": int(self.board_id),
             "col_id": self.phone_dedupe_col_id,
             "val": phone_limpio
         }
 
-        data = await self._graphql(query, variables)
+        data = await self._graphql(_Q_FIND_ITEM_BY_PHONE, variables)
         items = data.get("data", {}).get("items_page_by_column_values", {}).get("items", [])
 
         if items:
             return items[0]["id"]
         return None
 
+    def _remember_item_id(self, phone_limpio: str, item_id: str):
+        cache = self._item_id_cache
+        cache.pop(phone_limpio, None)
+        if len(cache) >= _ITEM_ID_CACHE_MAX:
+            del cache[next(iter(cache))]
+        cache[phone_limpio] = (item_id, time.monotonic() + _ITEM_ID_TTL_SECONDS)
+
+    def _remember_item_name(self, item_id: str, item_name: str):
+        names = self._item_names
+        names.pop(item_id, None)
+        if len(names) >= _ITEM_ID_CACHE_MAX:
+            del names[next(iter(names))]
+        names[item_id] = item_name
+
     async def _get_group_id_by_name(self, group_name: str):
         """Busca un grupo por nombre y retorna su ID."""
         if not group_name:
             return None
 
-        query = """
-        query ($board_id: ID!) {
-          boards(ids: [$board_id]) {
-            groups {
-              id
-              title
-            }
-          }
-        }
-        """
+        cache_key = f"{self.board_id}:{group_name.upper()}"
+        cached = self._group_id_cache.get(cache_key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
         variables = {"board_id": int(self.board_id)}
 
-        data = await self._graphql(query, variables)
+        data = await self._graphql(_Q_BOARD_GROUPS, variables)
         boards = data.get("data", {}).get("boards", [])
 
         if not boards:
@@ -150,6 +275,13 @@ class MondayService:
 
         groups = boards[0].get("groups", [])
 
+        # Ya que la consulta trae todos los grupos, se cachean todos de una vez
+        expires_at = time.monotonic() + _GROUP_ID_TTL_SECONDS
+        for group in groups:
+            title = group.get("title", "")
+            if title and group.get("id"):
+                self._group_id_cache[f"{self.board_id}:{title.upper()}"] = (group["id"], expires_at)
+
         # Buscar grupo que coincida con el nombre (case insensitive)
         for group in groups:
             if group.get("title", "").upper() == group_name.upper():
@@ -159,6 +291,29 @@ class MondayService:
         logger.warning(f"⚠️ Grupo '{group_name}' no encontrado en el tablero")
         return None
 
+    def _forget_group_id(self, group_id: str):
+        """Saca un group_id de ambas caches (por nombre y la del mes actual)."""
+        for key in [k for k, (gid, _) in self._group_id_cache.items() if gid == group_id]:
+            del self._group_id_cache[key]
+        if self._current_group_cache[1] == group_id:
+            self._current_group_cache = ("", None, 0.0)
+
+    async def _current_group_id(self) -> Tuple[str, Optional[str]]:
+        """
+        Nombre e ID del grupo del mes actual, cacheados por una hora (solo si existe).
+        El nombre se recalcula siempre (es barato): al cambiar de mes la cache deja de valer.
+        """
+        name = _get_current_month_group_name()
+        cached_name, group_id, expires_at = self._current_group_cache
+        if cached_name == name and time.monotonic() < expires_at:
+            return name, group_id
+
+        group_id = await self._get_group_id_by_name(name)
+        # Un grupo no encontrado no se cachea: si lo crean, el siguiente lead ya cae ahí
+        if group_id:
+            self._current_group_cache = (name, group_id, time.monotonic() + _CURRENT_GROUP_TTL_SECONDS)
+        return name, group_id
+
     async def create_or_update_lead(self, lead_data: dict, stage: str = None, add_note: str = None):
         """
         Crea o actualiza un lead en Monday.com con soporte de funnel.
@@ -184,8 +339,15 @@ class MondayService:
             logger.warning("⚠️ Lead sin teléfono, no se puede procesar.")
             return None
 
-        # 2. BUSCAR DUPLICADO (Lógica Find-First)
-        item_id = await self._find_item_by_phone(phone_limpio)
+        # 2. BUSCAR DUPLICADO (Lógica Find-First, primero en cache local)
+        cached = self._item_id_cache.get(phone_limpio)
+        from_cache = bool(cached and cached[1] > time.monotonic())
+        if from_cache:
+            item_id = cached[0]
+        else:
+            item_id = await self._find_item_by_phone(phone_limpio)
+            if item_id:
+                self._remember_item_id(phone_limpio, item_id)
 
         # 3. DEFINIR VALORES DE COLUMNAS
         col_vals = {}
@@ -209,6 +371,9 @@ class MondayService:
         elif stage and not self.stage_col_id:
             logger.warning(f"⚠️ Stage '{stage}' no aplicada - MONDAY_STAGE_COLUMN_ID no configurada")
 
+        # Nombre del item: "Nombre | Telefono"
+        item_name_display = f"{nombre} | {phone_limpio}"
+
         # 4. CREAR O ACTUALIZAR
         is_new = False
         if not item_id:
@@ -216,93 +381,91 @@ class MondayService:
             is_new = True
 
             # Buscar grupo del mes actual (ej. "FEBRERO 2026")
-            month_group_name = _get_current_month_group_name()
-            group_id = await self._get_group_id_by_name(month_group_name)
+            month_group_name, group_id = await self._current_group_id()
 
             if group_id:
                 logger.info(f"🆕 Creando lead [{stage or 'SIN_ETAPA'}] en grupo '{month_group_name}': {phone_limpio}")
-                query_create = """
-                mutation ($board_id: ID!, $group_id: String!, $name: String!, $vals: JSON!) {
-                    create_item (board_id: $board_id, group_id: $group_id, item_name: $name, column_values: $vals) { id }
-                }
-                """
+                query_create = _Q_CREATE_ITEM_IN_GROUP
             else:
                 logger.info(f"🆕 Creando lead [{stage or 'SIN_ETAPA'}] (sin grupo): {phone_limpio}")
-                query_create = """
-                mutation ($board_id: ID!, $name: String!, $vals: JSON!) {
-                    create_item (board_id: $board_id, item_name: $name, column_values: $vals) { id }
-                }
-                """
-
-            # Nombre del item: "Nombre | Telefono"
-            item_name_display = f"{nombre} | {phone_limpio}"
+                query_create = _Q_CREATE_ITEM
 
             vars_create = {
                 "board_id": int(self.board_id),
                 "name": item_name_display,
-                "vals": json.dumps(col_vals)
+                "vals": orjson.dumps(col_vals).decode()
             }
             if group_id:
                 vars_create["group_id"] = group_id
 
             res = await self._graphql(query_create, vars_create)
-            item_id = res.get("data", {}).get("create_item", {}).get("id")
+            if "errors" in res and group_id:
+                # El grupo cacheado pudo haberse borrado/recreado: se olvida y se crea sin grupo
+                logger.warning(f"⚠️ create_item falló en grupo {group_id}; reintentando sin grupo: {phone_limpio}")
+                self._forget_group_id(group_id)
+                del vars_create["group_id"]
+                res = await self._graphql(_Q_CREATE_ITEM, vars_create)
+            item_id = ((res.get("data") or {}).get("create_item") or {}).get("id")
+            if item_id:
+                self._remember_item_id(phone_limpio, item_id)
+                self._remember_item_name(item_id, item_name_display)
 
         else:
             # --- ACTUALIZAR EXISTENTE ---
             logger.info(f"♻️ Actualizando lead [{stage or 'SIN_ETAPA'}] (ID: {item_id})")
 
-            # Solo actualizar nombre si cambió de "Lead WhatsApp" a algo real
-            if nombre and nombre != "Lead WhatsApp":
-                # Actualizar también el nombre del item
-                query_update_name = """
-                mutation ($item_id: ID!, $board_id: ID!, $name: String!, $vals: JSON!) {
-                    change_multiple_column_values (item_id: $item_id, board_id: $board_id, column_values: $vals) { id }
-                }
-                """
-                vars_update = {
-                    "item_id": int(item_id),
-                    "board_id": int(self.board_id),
-                    "vals": json.dumps(col_vals)
-                }
-                await self._graphql(query_update_name, vars_update)
+            # Si ya tenemos el nombre real del cliente, se renombra el item en la misma
+            # mutation ("name" es columna válida), solo si cambió respecto a lo último escrito
+            rename = nombre != "Lead WhatsApp" and self._item_names.get(item_id) != item_name_display
+            if rename:
+                col_vals["name"] = item_name_display
+
+            # Columnas y nota adicional van en UNA sola request (dos mutations con alias)
+            # en vez de un round trip a Monday por cada una.
+            vars_update = {"item_id": int(item_id)}
+            if col_vals:
+                vars_update["board_id"] = int(self.board_id)
+                vars_update["vals"] = orjson.dumps(col_vals).decode()
+            if add_note:
+                vars_update["body"] = add_note
+
+            if col_vals and add_note:
+                query_update = _Q_UPDATE_COLUMNS_AND_NOTE
             elif col_vals:
-                query_update = """
-                mutation ($item_id: ID!, $board_id: ID!, $vals: JSON!) {
-                    change_multiple_column_values (item_id: $item_id, board_id: $board_id, column_values: $vals) { id }
-                }
-                """
-                vars_update = {
-                    "item_id": int(item_id),
-                    "board_id": int(self.board_id),
-                    "vals": json.dumps(col_vals)
-                }
-                await self._graphql(query_update, vars_update)
-
-        # 5. AGREGAR NOTA (si es nuevo o si se especifica nota adicional)
-        if item_id and (is_new or add_note):
-            if is_new:
-                # Nota inicial con todos los datos
-                detalles = (
-                    f"📊 ETAPA: {stage or 'MENSAJE'}\n"
-                    f"👤 Nombre: {nombre}\n"
-                    f"📞 Tel: {phone_limpio}\n"
-                    f"📝 Interés: {lead_data.get('interes', 'N/A')}\n"
-                )
-                if lead_data.get('cita'):
-                    detalles += f"📅 Cita: {lead_data.get('cita')}\n"
-                if lead_data.get('pago'):
-                    detalles += f"💰 Pago: {lead_data.get('pago')}\n"
+                query_update = _Q_UPDATE_COLUMNS
+            elif add_note:
+                query_update = _Q_CREATE_NOTE
             else:
-                # Solo la nota adicional
-                detalles = add_note or f"📊 Actualizado a etapa: {stage}"
-
-            query_note = """
-            mutation ($item_id: ID!, $body: String!) {
-                create_update (item_id: $item_id, body: $body) { id }
-            }
-            """
-            await self._graphql(query_note, {"item_id": int(item_id), "body": detalles})
+                query_update = None
+
+            if query_update:
+                res = await self._graphql(query_update, vars_update)
+                if "errors" in res and from_cache:
+                    # El item cacheado pudo haberse borrado/fusionado en Monday: se invalida y se
+                    # reintenta UNA vez buscando de nuevo (o creando) para no perder etapa ni nota.
+                    # La nueva llamada ya no encuentra cache, así que no vuelve a entrar aquí.
+                    self._item_id_cache.pop(phone_limpio, None)
+                    logger.warning(f"⚠️ Item cacheado {item_id} falló; reintentando con búsqueda: {phone_limpio}")
+                    return await self.create_or_update_lead(lead_data, stage=stage, add_note=add_note)
+                if "errors" in res:
+                    self._item_id_cache.pop(phone_limpio, None)
+                elif rename:
+                    self._remember_item_name(item_id, item_name_display)
+
+        # 5. NOTA INICIAL con todos los datos (solo leads nuevos)
+        if item_id and is_new:
+            detalles = (
+                f"📊 ETAPA: {stage or 'MENSAJE'}\n"
+                f"👤 Nombre: {nombre}\n"
+                f"📞 Tel: {phone_limpio}\n"
+                f"📝 Interés: {lead_data.get('interes', 'N/A')}\n"
+            )
+            if lead_data.get('cita'):
+                detalles += f"📅 Cita: {lead_data.get('cita')}\n"
+            if lead_data.get('pago'):
+                detalles += f"💰 Pago: {lead_data.get('pago')}\n"
+
+            await self._graphql(_Q_CREATE_NOTE, {"item_id": int(item_id), "body": detalles})
 
         return item_id
 